@@ -1,8 +1,34 @@
 """Library of functions for behavior analysis
     * import_behavior_data - inputs data from BORIS csv
+    * sniff_boris_csv - finds the header row and format of a BORIS export
+    * read_boris_csv - reads the events of a BORIS export
+    * read_video_timestamps - reads the clock time of each video frame
+    * align_video_frames - finds the fiber sample of each video frame
+    * video_time_to_sample - maps video times to fiber samples
+    * mask_to_intervals - start and stop samples of the True runs of a mask
+    * intervals_to_mask - boolean mask of intervals
+    * merge_intervals - sorts intervals and merges overlapping ones
+    * union_intervals - samples in either of two interval sets
+    * intersect_intervals - samples in both of two interval sets
+    * difference_intervals - samples in one interval set but not another
+    * filter_intervals - keeps intervals within a range of lengths
+    * behavior_names - names of the behaviors of a session
+    * behavior_intervals - intervals of one or more behaviors
+    * behavior_mask - boolean mask of one or more behaviors
+    * behavior_spans - start and end times of the shaded spans of a behavior
+    * plot_behavior - plots channels with behaviors shaded
+    * peri_event - matrix of a channel around events and its z-scores
     * plot_zscore - plots z-score for each behavior occurance
+
+    Behaviors are stored as intervals in fdata.attrs['behaviors'], by
+    behavior name: {'start': [...], 'stop': [...], 'subject': [...]}.
+    Intervals are half open sample ranges, start is the first sample
+    of an event and stop the sample after its last one. A POINT event
+    is one sample long. An interval set is a tuple of start and stop
+    numpy arrays.
 """
 import sys
+import csv
 from statistics import mean
 import pandas as pd
 import numpy as np
@@ -11,57 +37,573 @@ import scipy.stats as ss
 import plotly.express as px
 import plotly.graph_objects as go
 from plotly.subplots import make_subplots
+import fpho_setup
 
 
-def import_behavior_data(BORIS_filename, fdata):
+def import_behavior_data(BORIS_filename, fdata, video_filename=None,
+                         video_fps=30, behavior_columns=False):
     """Takes a file name, returns a dataframe of parsed data
 
         Parameters
         ----------
         BORIS_filename: string
-                        The path to the CSV file
+                        The path to the CSV file, any format read by
+                        read_boris_csv
+        video_filename: string or None
+                        file with the clock time of each video frame.
+                        If given, BORIS times are mapped through the
+                        video frames with align_video_frames, otherwise
+                        they are matched to fTimeGreen directly
+        video_fps: float
+                        frame rate BORIS used for the video
+        behavior_columns: bool
+                        also add a boolean column for every behavior
 
         Returns:
         --------
-        behaviorData: pandas dataframe
-                contains:
-                     Time(total msec), Time(sec), Subject,
-                     Behavior, Status
+        fdata: pandas dataframe
+                session with the intervals of every behavior in
+                fdata.attrs['behaviors']
         """
     
     # Open file, catch errors
     try:
-        BORISData = pd.read_csv(BORIS_filename, header=15)  # starts at data
-    except FileNotFoundError:
-        print("Could not find file: " + BORIS_filename)
+        BORISData = read_boris_csv(BORIS_filename)
+        if video_filename is not None:
+            frame_index = align_video_frames(fdata, video_filename)
+    except FileNotFoundError as error:
+        print("Could not find file: " + str(error.filename))
         sys.exit(1)
-    except PermissionError:
-        print("Could not access file: " + BORIS_filename)
+    except PermissionError as error:
+        print("Could not access file: " + str(error.filename))
         sys.exit(2)
-        
-    UniqueBehaviors=BORISData['Behavior'].unique()
-    
-    for beh in UniqueBehaviors:
-        IdxOfBeh = [i for i in range(len(BORISData['Behavior'])) if BORISData.loc[i, 'Behavior'] == beh]                    
-        j=0
-        fdata[beh]=False
-        while j < len(IdxOfBeh):
-            if BORISData.loc[(IdxOfBeh[j]), 'Status']=='POINT': 
-                pointIdx=fdata['fTimeGreen'].searchsorted(BORISData.loc[IdxOfBeh[j],'Time'])
-                fdata.loc[pointIdx, beh]=True
-                j=j+1
-            elif BORISData.loc[(IdxOfBeh[j]), 'Status']=='START' and BORISData.loc[(IdxOfBeh[j+1]), 'Status']=='STOP':
-                startIdx=fdata['fTimeGreen'].searchsorted(BORISData.loc[IdxOfBeh[j],'Time'])
-                endIdx=fdata['fTimeGreen'].searchsorted(BORISData.loc[IdxOfBeh[j+1],'Time'])
-                fdata.loc[startIdx:endIdx, beh]=True
-                j=j+2
-            else: 
-                print("\nStart and stops for state behavior:" + beh + " are not paired correctly.\n")
-                sys.exit()
+
+    # Fiber sample of every event, found at once
+    times = BORISData['Time'].to_numpy(dtype=np.float64)
+    if video_filename is not None:
+        sample_idx = video_time_to_sample(times, frame_index, video_fps)
+    else:
+        sample_idx = fdata['fTimeGreen'].searchsorted(times)
+
+    # Events of each behavior, in file order
+    codes, behaviors = pd.factorize(BORISData['Behavior'])
+    order = np.argsort(codes, kind='stable')
+    codes = codes[order]
+    sample_idx = np.asarray(sample_idx)[order]
+    status = BORISData['Status'].to_numpy()[order]
+    is_point = status == 'POINT'
+    is_start = status == 'START'
+    is_stop = status == 'STOP'
+
+    # Every START must be followed by a STOP of the same behavior
+    starts = np.flatnonzero(is_start)
+    stops = starts + 1
+    paired = stops < len(status)
+    paired[paired] = (is_stop[stops[paired]]
+                      & (codes[stops[paired]] == codes[starts[paired]]))
+    unpaired = ~(is_point | is_start | is_stop) | is_stop
+    unpaired[starts[~paired]] = True
+    unpaired[stops[paired]] = False
+    if unpaired.any():
+        beh = behaviors[codes[np.flatnonzero(unpaired)[0]]]
+        print("\nStart and stops for state behavior:" + str(beh)
+              + " are not paired correctly.\n")
+        sys.exit()
+
+    # Intervals of every event, POINT events are one sample long.
+    # Events after the last sample are dropped
+    if 'Subject' in BORISData.columns:
+        subjects = BORISData['Subject'].astype(str).to_numpy()[order]
+    else:
+        subjects = np.full(len(codes), '')
+    events = np.sort(np.concatenate([np.flatnonzero(is_point), starts]))
+    first = sample_idx[events]
+    # The STOP of a state event is the row after its START
+    last = sample_idx[events + ~is_point[events]]
+    keep = first < len(fdata)
+    events, first, last = events[keep], first[keep], last[keep]
+    last = np.minimum(last + 1, len(fdata))
+
+    behaviors_attr = dict(fdata.attrs.get('behaviors', {}))
+    bounds = np.searchsorted(codes[events], np.arange(len(behaviors) + 1))
+    for i, beh in enumerate(behaviors):
+        group = slice(bounds[i], bounds[i + 1])
+        behaviors_attr[str(beh)] = {
+            'start': first[group].tolist(),
+            'stop': last[group].tolist(),
+            'subject': subjects[events[group]].tolist()}
+    fdata.attrs['behaviors'] = behaviors_attr
+    if behavior_columns:
+        fdata = fpho_setup.add_columns(
+            fdata, {beh: behavior_mask(fdata, [beh])[0] for beh in behaviors})
     return(fdata)
 
-def plot_behavior(fdata, key, channels):
-    fig = make_subplots(rows=len(channels), cols=1, subplot_titles=[channel for channel in channels], shared_xaxes=True)
+
+def sniff_boris_csv(BORIS_filename, n_bytes=8192):
+    """Finds the header row and format of a BORIS export from its
+        first bytes
+
+        Parameters
+        ----------
+        BORIS_filename: string
+                path to the CSV file
+        n_bytes: integer
+                number of bytes searched for the header row
+
+        Returns:
+        --------
+        sniffed: dictionary
+                'header': row of the column names,
+                'format': 'tabular' for one row per event with a
+                Status, 'aggregated' for one row per event with its
+                start and stop, 'points' for a list of event times,
+                'independent variables': whether the metadata block
+                has independent variables,
+                'columns': names of the Time, Subject, Behavior and
+                Status columns, or of the Start, Stop, Subject,
+                Behavior and Behavior type columns, None if missing
+    """
+    with open(BORIS_filename, newline='') as f:
+        text = f.read(n_bytes)
+    lines = text.splitlines()
+    if len(text) == n_bytes:
+        # The last line may be cut off
+        lines = lines[:-1]
+    variables = False
+    for row, fields in enumerate(csv.reader(lines)):
+        names = {field.strip().lower(): field for field in fields}
+        if 'independent variables' in names:
+            variables = True
+        if 'behavior' not in names:
+            continue
+        columns = {'Subject': names.get('subject'),
+                   'Behavior': names['behavior']}
+        if 'start (s)' in names and 'stop (s)' in names:
+            columns.update({'Start': names['start (s)'],
+                            'Stop': names['stop (s)'],
+                            'Behavior type': names.get('behavior type')})
+            sniffed_format = 'aggregated'
+        else:
+            times = [field for field in fields
+                     if field.strip().lower().startswith('time')]
+            if len(times) == 0:
+                continue
+            columns['Time'] = names.get('time', times[0])
+            columns['Status'] = names.get('status')
+            sniffed_format = 'points' if columns['Status'] is None \
+                else 'tabular'
+        return {'header': row, 'format': sniffed_format,
+                'independent variables': variables, 'columns': columns}
+    print("\nError: could not find the Behavior column in the first "
+          + str(n_bytes) + " bytes of " + BORIS_filename)
+    sys.exit(1)
+
+
+def read_boris_csv(BORIS_filename, n_bytes=8192):
+    """Reads the events of a BORIS export in any format found by
+        sniff_boris_csv
+
+        Parameters
+        ----------
+        BORIS_filename: string
+                path to the CSV file
+        n_bytes: integer
+                number of bytes searched for the header row
+
+        Returns:
+        --------
+        BORISData: pandas dataframe
+                one row per event with Time (sec), Subject, Behavior
+                and Status (POINT, START or STOP). Aggregated events
+                are split into a START and a STOP row
+    """
+    sniffed = sniff_boris_csv(BORIS_filename, n_bytes)
+    columns = {name: column for name, column in sniffed['columns'].items()
+               if column is not None}
+    dtypes = {column: (np.float64 if name in ('Time', 'Start', 'Stop')
+                       else str) for name, column in columns.items()}
+    data = pd.read_csv(BORIS_filename, skiprows=sniffed['header'],
+                       usecols=list(dtypes), dtype=dtypes)
+    data = data.rename(columns={column: name
+                                for name, column in columns.items()})
+    if 'Subject' not in data.columns:
+        data['Subject'] = ''
+    data['Subject'] = data['Subject'].fillna('')
+
+    if sniffed['format'] == 'points':
+        data['Status'] = 'POINT'
+    elif sniffed['format'] == 'aggregated':
+        if 'Behavior type' in data.columns:
+            point = data['Behavior type'].str.upper().eq('POINT').to_numpy()
+        else:
+            point = (data['Start'] == data['Stop']).to_numpy()
+        # Each event becomes a START row followed by its STOP row, a
+        # POINT event only keeps the first
+        n = len(data)
+        events = pd.DataFrame({
+            'Time': np.column_stack([data['Start'],
+                                     data['Stop']]).ravel(),
+            'Subject': np.repeat(data['Subject'].to_numpy(), 2),
+            'Behavior': np.repeat(data['Behavior'].to_numpy(), 2),
+            'Status': np.where(point[:, None], 'POINT',
+                               np.array([['START', 'STOP']] * n
+                                        ).reshape(n, 2)).ravel()})
+        keep = np.column_stack([np.ones(n, dtype=bool), ~point]).ravel()
+        data = events[keep].reset_index(drop=True)
+    return data[['Time', 'Subject', 'Behavior', 'Status']]
+
+
+def read_video_timestamps(video_filename, time_scale=1e-3):
+    """Reads a file with the clock time of each video frame
+
+        Parameters
+        ----------
+        video_filename: string
+                one timestamp per line, e.g.
+                'video time stamp_2020-10-12T15_30_41.csv'
+        time_scale: float
+                seconds per timestamp unit
+
+        Returns:
+        --------
+        video_times: numpy array
+                clock time of each frame in seconds. A partly written
+                final line goes back in time, so the frames from the
+                first step back on are discarded
+    """
+    video = pd.read_csv(video_filename, sep=r'\s+', header=None,
+                        usecols=[0], dtype=np.float64, memory_map=True)
+    video_times = video[0].to_numpy() * time_scale
+    backwards = np.flatnonzero(np.diff(video_times) < 0)
+    if len(backwards) > 0:
+        video_times = video_times[:backwards[0] + 1]
+    return video_times
+
+
+def align_video_frames(fdata, video_filename, time_scale=1e-3):
+    """Finds the fiber sample nearest to each video frame
+
+        Both recordings must use the same clock. The index is built
+        with one searchsorted, so the clock drift between video and
+        fiber data is corrected once per session
+
+        Parameters
+        ----------
+        fdata: pandas dataframe
+                session with fTimeGreen and fdata.attrs['start time']
+        video_filename: string
+                file with the clock time of each video frame
+        time_scale: float
+                seconds per timestamp unit of the video file
+
+        Returns:
+        --------
+        frame_index: numpy array
+                row of fdata for each video frame
+    """
+    if 'start time' not in fdata.attrs:
+        print("\nError: the session has no start time, import the "
+              "fiber photometry file again to align it with video")
+        sys.exit(1)
+    fiber_times = fdata.attrs['start time'] + fdata['fTimeGreen'].to_numpy()
+    video_times = read_video_timestamps(video_filename, time_scale)
+    return fpho_setup.nearest_index(fiber_times, video_times)
+
+
+def video_time_to_sample(times, frame_index, video_fps=30):
+    """Maps times in the video (e.g. BORIS times) to fiber samples
+
+        Parameters
+        ----------
+        times: numpy array
+                seconds from the start of the video
+        frame_index: numpy array
+                row of fdata for each video frame, from
+                align_video_frames
+        video_fps: float
+                frame rate of the video file
+
+        Returns:
+        --------
+        sample_idx: numpy array
+                row of fdata for each time
+    """
+    frames = np.rint(np.asarray(times) * video_fps).astype(np.int64)
+    frames = np.clip(frames, 0, len(frame_index) - 1)
+    return frame_index[frames]
+
+
+def mask_to_intervals(mask):
+    """Returns the start and stop samples of the True runs of a mask
+
+        Parameters
+        ----------
+        mask: numpy array
+                boolean mask of samples
+
+        Returns:
+        --------
+        intervals: tuple
+                start and stop arrays, stop is the sample after a run
+    """
+    edges = np.diff(np.concatenate([[0], np.asarray(mask, dtype=np.int8),
+                                    [0]]))
+    return np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)
+
+
+def intervals_to_mask(intervals, n_samples):
+    """Returns a boolean mask of n_samples that is True in the intervals
+
+        Parameters
+        ----------
+        intervals: tuple
+                start and stop arrays, they may overlap
+        n_samples: integer
+                length of the mask
+    """
+    start, stop = (np.clip(np.asarray(x, dtype=np.int64), 0, n_samples)
+                   for x in intervals)
+    edges = (np.bincount(start, minlength=n_samples + 1)
+             - np.bincount(stop, minlength=n_samples + 1))
+    return np.cumsum(edges[:n_samples]) > 0
+
+
+def merge_intervals(intervals):
+    """Sorts intervals and merges the ones that overlap or touch
+
+        Parameters
+        ----------
+        intervals: tuple
+                start and stop arrays
+
+        Returns:
+        --------
+        intervals: tuple
+                sorted start and stop arrays without overlaps, empty
+                intervals are removed
+    """
+    start, stop = (np.asarray(x, dtype=np.int64) for x in intervals)
+    keep = stop > start
+    order = np.argsort(start[keep], kind='stable')
+    start, stop = start[keep][order], stop[keep][order]
+    if len(start) == 0:
+        return start, stop
+    end = np.maximum.accumulate(stop)
+    new = np.concatenate([[True], start[1:] > end[:-1]])
+    last = np.concatenate([np.flatnonzero(new)[1:] - 1, [len(start) - 1]])
+    return start[new], end[last]
+
+
+def combine_intervals(a, b, keep):
+    """Combines two interval sets sample by sample
+
+        Parameters
+        ----------
+        a, b: tuple
+                start and stop arrays
+        keep: function
+                takes two boolean arrays, whether samples are in a and
+                in b, and returns whether they are in the result
+
+        Returns:
+        --------
+        intervals: tuple
+                merged start and stop arrays of the result
+    """
+    a, b = merge_intervals(a), merge_intervals(b)
+    bounds = np.unique(np.concatenate(a + b))
+    # The samples from one bound up to the next are all in or all out
+    # of each set
+    in_a = (np.searchsorted(a[0], bounds, 'right')
+            > np.searchsorted(a[1], bounds, 'right'))
+    in_b = (np.searchsorted(b[0], bounds, 'right')
+            > np.searchsorted(b[1], bounds, 'right'))
+    inside = keep(in_a, in_b)[:-1]
+    return merge_intervals((bounds[:-1][inside], bounds[1:][inside]))
+
+
+def union_intervals(a, b):
+    """Returns the intervals of samples in a or b"""
+    return combine_intervals(a, b, np.logical_or)
+
+
+def intersect_intervals(a, b):
+    """Returns the intervals of samples in both a and b"""
+    return combine_intervals(a, b, np.logical_and)
+
+
+def difference_intervals(a, b):
+    """Returns the intervals of samples in a but not in b"""
+    return combine_intervals(a, b, lambda in_a, in_b: in_a & ~in_b)
+
+
+def filter_intervals(intervals, min_length=0, max_length=None):
+    """Keeps the intervals within a range of lengths
+
+        Parameters
+        ----------
+        intervals: tuple
+                start and stop arrays
+        min_length: integer
+                shortest interval kept, in samples
+        max_length: integer or None
+                longest interval kept, in samples, None for no limit
+    """
+    start, stop = (np.asarray(x, dtype=np.int64) for x in intervals)
+    length = stop - start
+    keep = length >= min_length
+    if max_length is not None:
+        keep &= length <= max_length
+    return start[keep], stop[keep]
+
+
+def behavior_names(fdata):
+    """Returns the behaviors of a session, from its intervals and from
+        boolean columns of older summary files
+    """
+    names = list(fdata.attrs.get('behaviors', {}))
+    names += [name for name in fdata.select_dtypes(include=['bool']).columns
+              if name not in names]
+    return names
+
+
+def behavior_intervals(fdata, behs, subject=None):
+    """Returns the intervals where any of some behaviors occurs
+
+        Parameters
+        ----------
+        fdata: pandas dataframe
+                session with behaviors
+        behs: list
+                names of the behaviors, missing names are skipped
+        subject: string or None
+                only use events of this BORIS subject, None for all
+
+        Returns:
+        --------
+        intervals: tuple
+                merged start and stop arrays
+    """
+    stored = fdata.attrs.get('behaviors', {})
+    start, stop = [], []
+    for beh in behs:
+        if beh in stored:
+            keep = np.ones(len(stored[beh]['start']), dtype=bool)
+            if subject is not None:
+                keep = np.asarray(stored[beh]['subject']) == subject
+            start.append(np.asarray(stored[beh]['start'],
+                                    dtype=np.int64)[keep])
+            stop.append(np.asarray(stored[beh]['stop'],
+                                   dtype=np.int64)[keep])
+        elif beh in fdata.columns and fdata[beh].dtype == bool:
+            runs = mask_to_intervals(fdata[beh].to_numpy())
+            start.append(runs[0])
+            stop.append(runs[1])
+    if len(start) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    return merge_intervals((np.concatenate(start), np.concatenate(stop)))
+
+
+def behavior_mask(fdata, behs, subject=None):
+    """Returns a mask of the samples where any of some behaviors occurs
+
+        Parameters
+        ----------
+        fdata: pandas dataframe
+                session with behaviors
+        behs: list
+                names of the behaviors, missing names are skipped
+        subject: string or None
+                only use events of this BORIS subject, None for all
+
+        Returns:
+        --------
+        mask: numpy array
+                boolean mask of the samples of fdata
+        found: bool
+                whether any of the behaviors is in the session
+    """
+    found = any(beh in behavior_names(fdata) for beh in behs)
+    return (intervals_to_mask(behavior_intervals(fdata, behs, subject),
+                              len(fdata)), found)
+
+
+def behavior_spans(fdata, beh, resolution=None, small_spans='merge'):
+    """Returns the start and end times of the spans shaded for a behavior
+
+        Parameters
+        ----------
+        fdata: pandas dataframe
+                session with fTimeGreen and behaviors
+        beh: string
+                name of the behavior
+        resolution: integer or None
+                width of the plot in pixels, None to keep every span
+        small_spans: string
+                'merge' to join spans less than a pixel apart, 'cull'
+                to also drop spans narrower than a pixel
+
+        Returns:
+        --------
+        x0, x1: numpy arrays
+                start and end of each span in seconds. A span ends at
+                the first sample after the behavior, or at the last
+                sample of the session
+    """
+    time = fdata['fTimeGreen'].to_numpy()
+    start, stop = behavior_intervals(fdata, [beh])
+    x0 = time[start]
+    x1 = time[np.minimum(stop, len(time) - 1)]
+    if resolution is None or len(x0) == 0:
+        return x0, x1
+    if small_spans not in ('merge', 'cull'):
+        print("\nError: small_spans must be merge or cull")
+        sys.exit(1)
+    pixel = (time[-1] - time[0]) / resolution
+    new = np.concatenate([[True], x0[1:] - x1[:-1] >= pixel])
+    last = np.concatenate([np.flatnonzero(new)[1:] - 1, [len(x0) - 1]])
+    x0, x1 = x0[new], x1[last]
+    if small_spans == 'cull':
+        keep = x1 - x0 >= pixel
+        x0, x1 = x0[keep], x1[keep]
+    return x0, x1
+
+
+def plot_behavior(fdata, key, channels, resolution=None,
+                  small_spans='merge'):
+    """Plots channels with the spans of every behavior shaded
+
+        Parameters
+        ----------
+        fdata: pandas dataframe
+                session with behaviors
+        key: string
+                name of the session
+        channels: list
+                columns to plot, one row each
+        resolution: integer or None
+                width of the plot in pixels, spans closer than a pixel
+                are merged. None to keep every span
+        small_spans: string
+                'merge' to join spans less than a pixel apart, 'cull'
+                to also drop spans narrower than a pixel
+    """
+    fig = make_subplots(rows=len(channels), cols=1,
+                        subplot_titles=[channel for channel in channels],
+                        shared_xaxes=True)
+    behaviors = behavior_names(fdata)
+    colors = ['#636EFA', '#EF553B', '#00CC96', '#AB63FA', '#FFA15A',
+              '#19D3F3', '#FF6692', '#B6E880', '#FF97FF', '#FECB52']
+    # The spans are found once and each one shades every row, the
+    # x axes are shared
+    shapes = []
+    for j, beh in enumerate(behaviors):
+        x0, x1 = behavior_spans(fdata, beh, resolution, small_spans)
+        shapes += [dict(type='rect', xref='x', yref='paper',
+                        x0=start, x1=end, y0=0, y1=1,
+                        opacity=0.75, line_width=1, layer='below',
+                        fillcolor=colors[j % 10], name=beh)
+                   for start, end in zip(x0, x1)]
     for i, channel in enumerate(channels):
         fig.add_trace(
             go.Scatter(
@@ -72,37 +614,7 @@ def plot_behavior(fdata, key, channels):
             name =channel,
             showlegend=True), row=i+1, col=1
             )
-        behaviors = fdata.select_dtypes(include=['bool']).columns
-        colors=['#636EFA', '#EF553B', '#00CC96', '#AB63FA', '#FFA15A', '#19D3F3', '#FF6692', '#B6E880', '#FF97FF', '#FECB52']
         for j, beh in enumerate(behaviors):
-            flag = False
-            for k in range(len(fdata[channel])):
-                if fdata.at[k, beh] == True:
-                    if flag == False:
-                        start = fdata.at[k, 'fTimeGreen'] 
-                        flag = True
-                else:
-                    if flag == True:
-                        end = fdata.at[k, 'fTimeGreen'] 
-                        fig.add_vrect(
-                            x0=start, x1=end, opacity=0.75,
-                            line_width=1, 
-                            layer="below",
-                            fillcolor=colors[j%10],
-                            row=i+1, col=1,
-                            name=beh
-                            )
-                        flag = False
-            if flag == True:
-                end = fdata.at[k, 'fTimeGreen'] 
-                fig.add_vrect( x0=start, x1=end, 
-                        opacity=0.75,
-                        layer="below",
-                        line_width=1, 
-                        fillcolor=colors[j%10],
-                        row=i+1, col=1,
-                        name=beh
-                        )
             fig.add_annotation(xref="x domain", yref="y domain",
                 x=1, 
                 y=(j+1)/len(behaviors),
@@ -111,64 +623,166 @@ def plot_behavior(fdata, key, channels):
                 showarrow=False,
                 row=i+1, col=1
                 )
+    fig.update_layout(shapes=shapes)
     fig.show()
-                
-            
 
-def plot_zscore(fdata, key, channels, behs):   
+
+def peri_event(fdata, channel, event_times, pre=1, post=5,
+               baseline='clip', baseline_window=(4, 3)):
+    """Builds a matrix of a channel around each event and z-scores it
+
+        Windows have the same number of samples for every event, they
+        are found with one searchsorted. Events whose window or
+        baseline does not fit in the session are left out
+
+        Parameters
+        ----------
+        fdata: pandas dataframe
+                session with fTimeGreen
+        channel: string
+                column to analyse
+        event_times: list or numpy array
+                times of the events in seconds (fTimeGreen)
+        pre, post: float
+                seconds before and after each event in the window
+        baseline: string
+                'clip' z-scores each window with its own mean and
+                standard deviation, 'pre' subtracts the mean of
+                baseline_window before the event and divides by the
+                standard deviation of the channel, 'session' uses the
+                mean and standard deviation of the channel
+        baseline_window: tuple
+                start and end of the 'pre' baseline in seconds before
+                the event, e.g. (4, 3) for 4 to 3 seconds before
+
+        Returns:
+        --------
+        results: dictionary
+                'time': seconds from the event of each window sample,
+                'events': times of the events used,
+                'trials': events x samples matrix of the channel,
+                'zscore': z-scores of the trials,
+                'mean', 'sem': mean and standard error of the z-scores
+                at each sample
+    """
+    if baseline not in ('clip', 'pre', 'session'):
+        print("\nError: baseline must be clip, pre or session")
+        sys.exit(1)
+    time = fdata['fTimeGreen'].to_numpy()
+    values = fdata[channel].to_numpy(dtype=np.float64)
+    rate = 1 / np.median(np.diff(time))
+    offsets = np.arange(-int(round(pre * rate)), int(round(post * rate)) + 1)
+    base = np.arange(-int(round(baseline_window[0] * rate)),
+                     -int(round(baseline_window[1] * rate)))
+    if baseline == 'pre' and len(base) == 0:
+        print("\nError: baseline_window must start before it ends")
+        sys.exit(1)
+
+    event_times = np.asarray(event_times, dtype=np.float64)
+    idx = time.searchsorted(event_times)
+    first = offsets[0] if baseline != 'pre' else min(offsets[0], base[0])
+    last = offsets[-1] if baseline != 'pre' else max(offsets[-1], base[-1])
+    keep = (idx + first >= 0) & (idx + last < len(time))
+    idx, event_times = idx[keep], event_times[keep]
+    trials = values[idx[:, None] + offsets]
+
+    if baseline == 'clip':
+        zscore = ss.zscore(trials, axis=1)
+    elif baseline == 'pre':
+        mean = values[idx[:, None] + base].mean(axis=1, keepdims=True)
+        zscore = (trials - mean) / values.std()
+    else:
+        zscore = (trials - values.mean()) / values.std()
+    if len(idx) > 1:
+        sem = ss.sem(zscore, axis=0)
+    else:
+        sem = np.full(len(offsets), np.nan)
+    return {'time': offsets / rate, 'events': event_times,
+            'trials': trials, 'zscore': zscore,
+            'mean': zscore.mean(axis=0), 'sem': sem}
+
+
+def plot_zscore(fdata, key, channels, behs, pre=1, post=5, baseline='clip',
+                baseline_window=(4, 3)):
     """Takes a dataframe and creates plot of z-scores for
         each time a select behavior occurs with the avg
         z-score and SEM
+
+        Parameters
+        ----------
+        fdata: pandas dataframe
+                session with behaviors
+        key: string
+                name of the session
+        channels: list
+                columns to analyse
+        behs: list
+                behaviors, each onset is an event
+        pre, post, baseline, baseline_window:
+                window and baseline, see peri_event
     """
     for channel in channels:
         for beh in behs:
-            BehTimes=list(fdata[(fdata[beh]==True)]['fTimeGreen'])
-            fig = make_subplots(rows=1, cols=2, subplot_titles=('Full trace with events', 'average'))
+            onsets = behavior_intervals(fdata, [beh])[0]
+            BehTimes = fdata['fTimeGreen'].to_numpy()[onsets]
+            results = peri_event(fdata, channel, BehTimes, pre, post,
+                                 baseline, baseline_window)
+            fig = make_subplots(rows=1, cols=2,
+                                subplot_titles=('Full trace with events',
+                                                'average'))
             fig.add_trace(
                 go.Scatter(
-                x=fdata['fTimeGreen'],
-                y=fdata[channel],
-                mode="lines",
-                line=go.scatter.Line(color="Green"),
-                name =channel,
-                showlegend=True), row=1, col=1
+                    x=fdata['fTimeGreen'],
+                    y=fdata[channel],
+                    mode="lines",
+                    line=go.scatter.Line(color="Green"),
+                    name=channel,
+                    showlegend=True), row=1, col=1
             )
-            sum=[]
-            zscoresum=[]
-            for time in BehTimes:
-                tempy=fdata.loc[fdata['fTimeGreen'].searchsorted(time-1):fdata['fTimeGreen'].searchsorted(time+5),channel].values.tolist()
-                if len(sum)>1:
-                    sum = [sum[i] + tempy[i] for i in range(len(tempy))]
-                else:
-                    sum=tempy
-                x=fdata.loc[fdata['fTimeGreen'].searchsorted(time-1):fdata['fTimeGreen'].searchsorted(time+5),'fTimeGreen']
+            for time in results['events']:
                 fig.add_vline(x=time, line_dash="dot", row=1, col=1)
+            for zscore in results['zscore']:
                 fig.add_trace(
-                    go.Scatter( 
-                    x=x-time,
-                    y=ss.zscore(fdata.loc[fdata['fTimeGreen'].searchsorted(time-1):fdata['fTimeGreen'].searchsorted(time+5),channel]),
-                    mode="lines",
-                    line=dict(color="Black", width=0.5, dash = 'dot'),
-                    name =channel,
-                    showlegend=False), row=1, col=2
+                    go.Scatter(
+                        x=results['time'],
+                        y=zscore,
+                        mode="lines",
+                        line=dict(color="Black", width=0.5, dash='dot'),
+                        name=channel,
+                        showlegend=False), row=1, col=2
                 )
             fig.add_vline(x=0, line_dash="dot", row=1, col=2)
             fig.add_trace(
-                go.Scatter( 
-                x=x-time,
-                y=ss.zscore([i/len(BehTimes) for i in sum]),
-                mode="lines",
-                line=dict(color="Red", width=3),
-                name =channel,
-                showlegend=False), row=1, col=2
-                )
+                go.Scatter(
+                    x=np.concatenate([results['time'],
+                                      results['time'][::-1]]),
+                    y=np.concatenate([results['mean'] + results['sem'],
+                                      (results['mean']
+                                       - results['sem'])[::-1]]),
+                    fill='toself',
+                    fillcolor='rgba(255,0,0,0.2)',
+                    line=dict(width=0),
+                    name='SEM',
+                    showlegend=False), row=1, col=2
+            )
+            fig.add_trace(
+                go.Scatter(
+                    x=results['time'],
+                    y=results['mean'],
+                    mode="lines",
+                    line=dict(color="Red", width=3),
+                    name=channel,
+                    showlegend=False), row=1, col=2
+            )
+            animal = fpho_setup.session_info(fdata, 'animalID')
+            date = fpho_setup.session_info(fdata, 'date')
             fig.update_layout(
-            title= beh + ' overlaid on ' + channel + ' for animal ' +str(fdata['animalID'][0]) + ' on ' + str(fdata['date'][0]),
-            xaxis_title='Time')
+                title=(beh + ' overlaid on ' + channel + ' for animal '
+                       + str(animal) + ' on ' + str(date)),
+                xaxis_title='Time')
             fig.show()
     return
-    # built in zscore function?
-    # don't pick a baseline, instead use the mean (of the clip) as the baseline
+
 
 def plot_FFT(df, channels):
     for channel in channels:
@@ -205,15 +819,10 @@ def plot_FFT(df, channels):
     
 def behavior_on(df, beh):
     behaviorname=''
-    flag=False
     for name in beh:
         behaviorname= behaviorname + ' ,' + name
-        if name in df.columns:
-            flag=True
-    if flag:
-        behaviorSlice=df.loc[:,beh]
-        TrueTimes = behaviorSlice.any(axis=1)
-    else:
+    TrueTimes, flag = behavior_mask(df, beh)
+    if not flag:
         print(behaviorname + ' not found in this trial')
     
     return(TrueTimes, flag)
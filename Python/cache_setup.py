@@ -0,0 +1,438 @@
+"""Library of functions for storing parsed fiber photometry sessions
+    * file_hash - hashes the contents of a file
+    * cache_key - builds a cache key from a file and its parameters
+    * save_columns - writes a dataframe as a columnar directory
+    * load_columns - reads some or all columns of a columnar directory
+    * save_session - writes a dataframe to the cache, removing the
+      least recently used sessions
+    * load_session - reads a dataframe back from the cache
+    * filtered_filename - path of the filtered copy of a summary file
+    * write_summary - writes a summary file as csv, parquet or npy
+    * read_attrs - reads the json sidecar of a summary file
+    * read_summary - reads a summary file, using the cache if possible
+    * fit_key - builds a cache key from a model, its data and options
+    * load_fit - reads cached fit parameters
+    * save_fit - writes fit parameters, removing the least recently used
+
+    A columnar directory holds one .npy file per numeric column and a
+    meta.json sidecar with the column order, every text column and the
+    dataframe attrs. Text columns that hold a single value (animalID,
+    date, description) are stored only once. Cached sessions are
+    columnar directories named by their key. Like fits, loading a
+    session marks it as recently used, and the least recently used
+    sessions are removed once there are more than a set number.
+
+    Fit parameters are cached as small json files in the fits folder
+    of the cache directory. Reading a fit marks it as recently used,
+    and the least recently used fits are removed once there are more
+    than a set number.
+
+    Compact sessions keep their metadata and fit parameters in
+    fdata.attrs. Csv and parquet summaries store the attrs in a json
+    sidecar next to the file, e.g. test_Summary.csv.json.
+"""
+
+import os
+import sys
+import json
+import shutil
+import hashlib
+import tempfile
+import numpy as np
+import pandas as pd
+
+# Increase when the cache layout changes so old entries are ignored
+CACHE_VERSION = 2
+
+
+def file_hash(filename, block_size=1 << 20):
+    """Returns the sha256 hex digest of a file's contents
+
+        Parameters
+        ----------
+        filename: string
+                path of the file to hash
+        block_size: integer
+                number of bytes read at a time
+    """
+    digest = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def cache_key(filename, params):
+    """Returns a key for a file parsed with the given parameters
+
+        Parameters
+        ----------
+        filename: string
+                path of the input file
+        params: dictionary
+                every parameter that changes the parsed output,
+                values must be json serializable
+    """
+    description = json.dumps({'cache_version': CACHE_VERSION,
+                              'file': file_hash(filename),
+                              'params': params}, sort_keys=True)
+    return hashlib.sha256(description.encode()).hexdigest()
+
+
+def save_columns(fdata, directory):
+    """Writes a dataframe as a columnar directory
+
+        Parameters
+        ----------
+        fdata: pandas dataframe
+                session to write
+        directory: string
+                path of the directory, replaced if it exists
+    """
+    parent = os.path.dirname(os.path.abspath(directory))
+    os.makedirs(parent, exist_ok=True)
+    # Write into a temporary directory first so a crash never leaves
+    # a partial directory behind
+    tmp_dir = tempfile.mkdtemp(dir=parent)
+    columns = []
+    for i, name in enumerate(fdata.columns):
+        series = fdata[name]
+        if pd.api.types.is_numeric_dtype(series.dtype):
+            filename = 'col_%04d.npy' % i
+            np.save(os.path.join(tmp_dir, filename), series.to_numpy())
+            columns.append({'name': name, 'file': filename})
+        else:
+            values = series.tolist()
+            if len(values) > 0 and all(v == values[0] for v in values):
+                columns.append({'name': name, 'value': values[0]})
+            else:
+                columns.append({'name': name, 'values': values})
+
+    meta = {'cache_version': CACHE_VERSION, 'n_rows': len(fdata),
+            'columns': columns, 'attrs': fdata.attrs}
+    with open(os.path.join(tmp_dir, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+
+    if os.path.exists(directory):
+        shutil.rmtree(directory)
+    os.replace(tmp_dir, directory)
+
+
+def load_columns(directory, columns=None):
+    """Reads a columnar directory, loading only the requested columns
+
+        Parameters
+        ----------
+        directory: string
+                path of the directory
+        columns: list or None
+                names of the columns to load, None for all columns.
+                Names that are not in the directory are skipped
+
+        Returns:
+        --------
+        fdata: pandas dataframe or None
+                None if the directory is missing or unreadable
+    """
+    try:
+        with open(os.path.join(directory, 'meta.json')) as f:
+            meta = json.load(f)
+        if meta['cache_version'] != CACHE_VERSION:
+            return None
+        data = {}
+        for column in meta['columns']:
+            if columns is not None and column['name'] not in columns:
+                continue
+            if 'file' in column:
+                data[column['name']] = np.load(
+                    os.path.join(directory, column['file']))
+            elif 'value' in column:
+                data[column['name']] = [column['value']] * meta['n_rows']
+            else:
+                data[column['name']] = column['values']
+    except (OSError, ValueError, KeyError):
+        return None
+    fdata = pd.DataFrame(data, index=pd.RangeIndex(meta['n_rows']))
+    fdata.attrs.update(meta.get('attrs', {}))
+    return fdata
+
+
+def _remove_least_recent(paths, max_entries):
+    """Removes the least recently modified paths beyond max_entries
+
+        Parameters
+        ----------
+        paths: list
+                files or directories to choose from
+        max_entries: integer
+                number of paths kept
+    """
+    entries = []
+    for path in paths:
+        try:
+            entries.append((os.stat(path).st_mtime_ns, path))
+        except FileNotFoundError:
+            pass
+    entries.sort()
+    for _, path in entries[:max(len(entries) - max_entries, 0)]:
+        try:
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+        except FileNotFoundError:
+            # Removed by another process at the same time
+            pass
+
+
+def save_session(fdata, cache_dir, key, max_sessions=20):
+    """Writes a dataframe to the cache under the given key
+
+        Parameters
+        ----------
+        fdata: pandas dataframe
+                session to cache
+        cache_dir: string
+                directory holding all cached sessions
+        key: string
+                key from cache_key
+        max_sessions: integer
+                number of sessions kept, the least recently used
+                sessions are removed
+    """
+    save_columns(fdata, os.path.join(cache_dir, key))
+
+    # The new session is never removed, even if its time ties with
+    # others. Temporary directories of sessions being written are
+    # skipped
+    sessions = [entry.path for entry in os.scandir(cache_dir)
+                if entry.is_dir() and entry.name not in ('fits', key)
+                and not entry.name.startswith('tmp')]
+    _remove_least_recent(sessions, max_sessions - 1)
+
+
+def load_session(cache_dir, key, columns=None):
+    """Reads a dataframe from the cache
+
+        Parameters
+        ----------
+        cache_dir: string
+                directory holding all cached sessions
+        key: string
+                key from cache_key
+        columns: list or None
+                names of the columns to load, None for all columns
+
+        Returns:
+        --------
+        fdata: pandas dataframe or None
+                None if the key is not cached or the entry is unreadable
+    """
+    directory = os.path.join(cache_dir, key)
+    fdata = load_columns(directory, columns)
+    if fdata is not None:
+        # Mark the session as recently used
+        try:
+            os.utime(directory)
+        except OSError:
+            pass
+    return fdata
+
+
+def summary_filename(output_filename, summary_format='csv'):
+    """Returns the summary path for an output name and format"""
+    if summary_format == 'csv':
+        return output_filename + '_Summary.csv'
+    if summary_format == 'parquet':
+        return output_filename + '_Summary.parquet'
+    if summary_format == 'npy':
+        return output_filename + '_Summary'
+    print("\nError: summary_format must be csv, parquet or npy")
+    sys.exit(1)
+
+
+def filtered_filename(filename):
+    """Returns the path filtered or decimated data is written to, so
+        the full rate summary it came from is kept
+    """
+    for extension in ('.csv', '.parquet'):
+        if filename.endswith(extension):
+            return filename[:-len(extension)] + '_Filtered' + extension
+    return filename.rstrip('/') + '_Filtered'
+
+
+def write_summary(fdata, filename):
+    """Writes a summary file, the format is set by its extension
+
+        Parameters
+        ----------
+        fdata: pandas dataframe
+                session to write
+        filename: string
+                .csv or .parquet file, any other name is written
+                as a columnar npy directory
+    """
+    if filename.endswith('.csv'):
+        fdata.to_csv(filename, index=False)
+    elif filename.endswith('.parquet'):
+        try:
+            fdata.to_parquet(filename, index=False)
+        except ImportError:
+            print("\nError: writing parquet files requires pyarrow")
+            sys.exit(1)
+    else:
+        save_columns(fdata, filename)
+        return
+
+    if fdata.attrs:
+        with open(filename + '.json', 'w') as f:
+            json.dump(fdata.attrs, f)
+    elif os.path.exists(filename + '.json'):
+        os.remove(filename + '.json')
+
+
+def read_attrs(filename):
+    """Returns the attrs stored in the json sidecar of a summary file"""
+    if not os.path.exists(filename + '.json'):
+        return {}
+    with open(filename + '.json') as f:
+        return json.load(f)
+
+
+def read_summary(filename, cache_dir=None, columns=None, max_sessions=20):
+    """Reads a summary file, skipping csv parsing when it is cached
+
+        Parameters
+        ----------
+        filename: string
+                path of a .csv or .parquet summary file or of a
+                columnar npy directory
+        cache_dir: string or None
+                directory holding all cached sessions, None to
+                always parse csv files
+        columns: list or None
+                names of the columns to read, None for all columns.
+                Names that are not in the file are skipped
+        max_sessions: integer
+                number of sessions kept in cache_dir, see save_session
+
+        Returns:
+        --------
+        fdata: pandas dataframe
+                contents of the summary file
+    """
+    if os.path.isdir(filename):
+        fdata = load_columns(filename, columns)
+        if fdata is None:
+            print("Could not read summary directory: " + filename)
+            sys.exit(1)
+        return fdata
+
+    if filename.endswith('.parquet'):
+        try:
+            import pyarrow.parquet as pq
+        except ImportError:
+            print("\nError: reading parquet files requires pyarrow")
+            sys.exit(1)
+        names = pq.ParquetFile(filename).schema.names
+        if columns is not None:
+            names = [name for name in names if name in columns]
+        fdata = pd.read_parquet(filename, columns=names)
+        fdata.attrs.update(read_attrs(filename))
+        return fdata
+
+    if cache_dir is None:
+        if columns is None:
+            fdata = pd.read_csv(filename)
+        else:
+            fdata = pd.read_csv(filename,
+                                usecols=lambda name: name in columns)
+        fdata.attrs.update(read_attrs(filename))
+        return fdata
+
+    params = {'reader': 'summary_csv'}
+    if os.path.exists(filename + '.json'):
+        params['attrs'] = file_hash(filename + '.json')
+    key = cache_key(filename, params)
+    fdata = load_session(cache_dir, key, columns)
+    if fdata is None:
+        fdata = pd.read_csv(filename)
+        fdata.attrs.update(read_attrs(filename))
+        save_session(fdata, cache_dir, key, max_sessions)
+        if columns is not None:
+            fdata = fdata[[name for name in fdata.columns
+                           if name in columns]]
+    return fdata
+
+
+def fit_key(model, arrays, options):
+    """Returns a key for a model fitted to some arrays
+
+        Parameters
+        ----------
+        model: string
+                name of the model, e.g. 'biexponential'
+        arrays: list
+                numpy arrays the model is fitted to, e.g. time and
+                channel values
+        options: dictionary
+                every option that changes the fit, values must be
+                json serializable
+    """
+    digest = hashlib.sha256(json.dumps(
+        {'cache_version': CACHE_VERSION, 'model': model,
+         'options': options}, sort_keys=True).encode())
+    for array in arrays:
+        array = np.ascontiguousarray(array)
+        digest.update(str((array.dtype.str, array.shape)).encode())
+        digest.update(array.data)
+    return digest.hexdigest()
+
+
+def load_fit(cache_dir, key):
+    """Returns cached fit parameters, None if the fit is not cached
+
+        Parameters
+        ----------
+        cache_dir: string
+                cache directory, fits are kept in its fits folder
+        key: string
+                key from fit_key
+    """
+    filename = os.path.join(cache_dir, 'fits', key + '.json')
+    try:
+        with open(filename) as f:
+            value = json.load(f)
+        # Mark the fit as recently used
+        os.utime(filename)
+    except (OSError, ValueError):
+        return None
+    return value
+
+
+def save_fit(cache_dir, key, value, max_fits=1000):
+    """Writes fit parameters to the cache
+
+        Parameters
+        ----------
+        cache_dir: string
+                cache directory, fits are kept in its fits folder
+        key: string
+                key from fit_key
+        value: dictionary or list
+                json serializable fit parameters
+        max_fits: integer
+                number of fits kept, the least recently used fits
+                are removed
+    """
+    directory = os.path.join(cache_dir, 'fits')
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_name = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(value, f)
+    os.replace(tmp_name, os.path.join(directory, key + '.json'))
+
+    # The new fit is never removed, even if its time ties with others
+    fits = [entry.path for entry in os.scandir(directory)
+            if entry.name.endswith('.json') and entry.name != key + '.json']
+    _remove_least_recent(fits, max_fits - 1)
@@ -11,6 +11,7 @@ import plotly.express as px
 import plotly.graph_objects as go
 from plotly.subplots import make_subplots
 from scipy.ndimage.filters import uniform_filter1d
+import behavior_setup
 
 
 def within_trial_pearsons(df, key, channels):
@@ -72,21 +73,18 @@ def behavior_specific_pearsons(df, file, channels, behs):
         sig2=[]
         for beh in behs:
             behaviorname=''
-            flag=False
             for name in beh:
                 behaviorname= behaviorname + ' ,' + name
-                if name in df.columns:
-                    flag=True
+            TrueTimes, flag = behavior_setup.behavior_mask(df, beh)
             if flag:
-                behaviorSlice=df.loc[:,beh]
-                TrueTimes = behaviorSlice.any(axis=1);
+                TrueTimes = pd.Series(TrueTimes, index=df.index)
                 corDf=pd.concat([df['fTimeGreen'], df[our_channels[0]], df[our_channels[1]], TrueTimes], axis=1)
                 corDf.columns = ['fTimeGreen', our_channels[0], our_channels[1], 'TrueTimes']
                 
-                sig1=corDf[corDf.TrueTimes == True][our_channels[0]]
-                sig2=corDf[corDf.TrueTimes == True][our_channels[1]]
-                sig1=ss.zscore(corDf[corDf.TrueTimes == True][our_channels[0]])
-                sig2=ss.zscore(corDf[corDf.TrueTimes == True][our_channels[1]])
+                # Z-scored within the behavior, like within_trial_pearsons
+                # and plot_zscore, whether or not transform_channels ran
+                sig1 = ss.zscore(corDf[corDf.TrueTimes][our_channels[0]])
+                sig2 = ss.zscore(corDf[corDf.TrueTimes][our_channels[1]])
                 
                 #difsig1=[sig1.iloc[i+1]-sig1.iloc[i] for i in range(len(sig1)-1)]
                 #difsig2=[sig2.iloc[i+1]-sig2.iloc[i] for i in range(len(sig2)-1)]
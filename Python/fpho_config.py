@@ -6,9 +6,56 @@ import pandas as pd
 import fpho_setup
 import behavior_setup
 import correlation_setup
+import cache_setup
 from os import path
 
 
+def filters_data(config):
+    """Returns whether config filters or decimates the signals"""
+    return (config.get('filter_lowpass') is not None
+            or config.get('filter_highpass') is not None
+            or config.get('decimate', 1) > 1)
+
+
+def analysis_columns(config):
+    """Returns the summary columns used by the analyses in config
+
+    Parameters
+    ----------
+    config: dictionary
+        contents of config.yml
+
+    Returns
+    -------
+        Set of column names, or None if every column is needed
+    """
+    # Normalized and filtered data are written back with every column
+    # and plot_behavior shades every behavior, so nothing is pruned.
+    # Behavior intervals are kept in the attrs, which are always read
+    if ((config['write_xlsx'] is True
+         and (config['normalize_data'] is True or filters_data(config)))
+            or config['plot_behavior'] is True):
+        return None
+
+    columns = {'animalID', 'date', 'description', 'fTimeGreen'}
+    if config['plot_raw_signal'] is True:
+        columns.update(['fTimeIso', 'fTimeRed',
+                        'f1GreenGreen', 'f1GreenIso', 'f1RedRed', 'f1RedIso',
+                        'f2GreenGreen', 'f2GreenIso', 'f2RedRed', 'f2RedIso'])
+    if config['normalize_data'] is True:
+        columns.update(config['all_signals'] + config['all_references'])
+    if config['plot_zscore'] is True:
+        columns.update(config['all_signals'] + config['zscore_behs'])
+    if (config['fourier_transform'] is True
+            or config['within_trial_pearsons'] is True
+            or config['behavior_specific_pearsons'] is True):
+        columns.update(channel + ' final normalized'
+                       for pair in config['channels'] for channel in pair)
+    if config['behavior_specific_pearsons'] is True:
+        columns.update(name for beh in config['behaviors'] for name in beh)
+    return columns
+
+
 def main():
     """Runs functions in fpho_setup, processes config.yml
 
@@ -40,65 +87,66 @@ def main():
       
     # Generate the dataframe with new data
     if config['import_new'] is True:
-        fpho_df = fpho_setup.import_fpho_data(input_filename=(
-                                              config['input_filename']),
-                                          output_filename=(
-                                              config['output_filename']),
-                                          f1greencol=(
-                                              config['f1greencol']),
-                                          f1redcol=(
-                                              config['f1redcol']),
-                                          f2greencol=(
-                                              config['f2greencol']),
-                                          f2redcol=(
-                                              config['f2redcol']),
-                                          animal_ID=(
-                                              config['animal_ID']),
-                                          exp_date=(
-                                              config['exp_date']),
-                                          exp_desc=(
-                                              config['exp_desc']),
-                                          frameshift=(
-                                              config['frameshift']),
-                                          framedrops=(
-                                              config['framedrops']))
-
-        if config['write_xlsx'] is True:          
-            output_xlsx = config['output_filename'] + '_Summary.csv'
+        fpho_df = fpho_setup.import_fpho_data(
+            input_filename=config['input_filename'],
+            output_filename=config['output_filename'],
+            f1greencol=config['f1greencol'],
+            f1redcol=config['f1redcol'],
+            f2greencol=config['f2greencol'],
+            f2redcol=config['f2redcol'],
+            animal_ID=config['animal_ID'],
+            exp_date=config['exp_date'],
+            exp_desc=config['exp_desc'],
+            frameshift=config.get('frameshift', False),
+            framedrops=config.get('framedrops'),
+            chunksize=config.get('import_chunksize'),
+            cache_dir=config.get('cache_dir'),
+            compact=config.get('compact_session', False),
+            float32=config.get('float32', False),
+            engine=config.get('csv_engine'),
+            timestamp_filename=config.get('timestamp_filename'),
+            first_flag=config.get('legacy_first_flag', 18),
+            max_sessions=config.get('session_cache_size', 20))
+
+        # Imports behavior data associated with the newly imported file
+        # if specified
+        if config['import_behavior'] is True:
+            fpho_df = behavior_setup.import_behavior_data(
+                config['BORIS_file'], fpho_df,
+                config.get('video_timestamp_file'),
+                config.get('video_fps', 30),
+                config.get('behavior_columns', False))
+
+        output_xlsx = cache_setup.summary_filename(
+            config['output_filename'], config.get('summary_format', 'csv'))
+        if config['write_xlsx'] is True:
             if path.exists(output_xlsx):
                 answer=input('Are you sure you want to overwrite'+output_xlsx+'(y or n)')
                 if answer != 'y':
                     print('Did not overwrite' + output_xlsx)
                     print('Change output_filename or write_xlsx value and rerun')
                     sys.exit()
-            
-            fpho_df.to_csv(output_xlsx, index=False)
-            print('Summary CSV file has been saved to ' + config['output_filename'] + '_Summary.csv')
-        
-        #Imports behavior data associated with the newly imported file if specified
-        if config['import_behavior'] is True:
-            fpho_df = behavior_setup.import_behavior_data(
-                                                config['BORIS_file'],
-                                                fpho_df)
-            if config['write_xlsx'] is True:
-                output_xlsx = config['output_filename'] + '_Summary.csv'
-                if path.exists(output_xlsx):
-                    answer=input('Are you sure you want to overwrite'+output_xlsx+'(y or n)')
-                    if answer != 'y':
-                            print('Did not overwrite' + output_xlsx)
-                            print('Change output_filename or write_xlsx value and rerun')
-                            sys.exit()
-
-                fpho_df.to_csv(output_xlsx, index=False)
-                print('Behavior data has been added to the summary file')
-        
-        all_data['output_xlsx']=fpho_df
+
+            cache_setup.write_summary(fpho_df, output_xlsx)
+            print('Summary file has been saved to ' + output_xlsx)
+
+            # Saves the frame drop report next to the summary file
+            if len(fpho_df.attrs.get('frame drops', {}).get('row', [])) > 0:
+                output_drops = config['output_filename'] + '_FrameDrops.csv'
+                pd.DataFrame(fpho_df.attrs['frame drops']).to_csv(
+                    output_drops, index=False)
+                print('Frame drop report has been saved to ' + output_drops)
+
+        all_data[output_xlsx] = fpho_df
         
     #reads in one or more dataframes and assigns them to a dictionary using the file name as the key    
     if config['reload_data'] is True:
+        columns = analysis_columns(config)
         for file in config['reload_filenames']:
-            fpho_df=pd.read_csv(file) 
-            all_data[file]=fpho_df
+            fpho_df = cache_setup.read_summary(
+                file, config.get('cache_dir'), columns,
+                config.get('session_cache_size', 20))
+            all_data[file] = fpho_df
             print('data was reloaded from', file)
 
     #Runs plots and analyses as specified on all fiberpho data sets
@@ -111,16 +159,59 @@ def main():
 
         # Normalizes signals of interest and plots normalization process
         if config['normalize_data'] is True:
-            fpho_df=fpho_setup.plot_fitted_exp(fpho_df, key,                      
-                                                 signals=config['all_signals'],                                    
-                                                 references=config['all_references'])
-            if config['write_xlsx'] is True:
-                fpho_df.to_csv(output_xlsx, index=False)
-                print(key, 'has been updated to include normalized data')
+            normalize_options = {
+                'signals': config['all_signals'],
+                'references': config['all_references'],
+                'fit_points': config.get('fit_points'),
+                'refine': config.get('fit_refine', True),
+                'workers': config.get('normalize_workers', 1),
+                'cache_dir': config.get('cache_dir'),
+                'max_fits': config.get('fit_cache_size', 1000),
+                'robust': config.get('robust_scaling', False),
+                'detrend_method': config.get('detrend_method',
+                                             'biexponential'),
+                'detrend_options': config.get('detrend_options')}
+            if config.get('plot_normalization', True) is True:
+                fpho_df = fpho_setup.plot_fitted_exp(fpho_df, key,
+                                                     **normalize_options)
+            else:
+                fpho_df = fpho_setup.normalize_channels(fpho_df,
+                                                        **normalize_options)
+
+        # Filters and decimates the signals before any analysis. The
+        # filtered data goes to its own file, so the full rate
+        # normalized summary is saved first
+        filtered = filters_data(config)
+        if (config['write_xlsx'] is True and filtered
+                and config['normalize_data'] is True):
+            cache_setup.write_summary(fpho_df, output_xlsx)
+            print(key, 'has been updated to include normalized data')
+        if filtered:
+            fpho_df = fpho_setup.filter_channels(
+                fpho_df, config.get('filter_lowpass'),
+                config.get('filter_highpass'), config.get('filter_order', 4),
+                config.get('decimate', 1), config.get('filter_columns'))
+
+        if config['normalize_data'] is True:
+            # dF/F and z-scores are stored for the analyses below
+            if config.get('transform_signals', False) is True:
+                fpho_df = fpho_setup.transform_channels(
+                    fpho_df, config['all_signals'],
+                    config.get('rolling_zscore_window', 60))
+        if config['write_xlsx'] is True and filtered:
+            output_filtered = cache_setup.filtered_filename(output_xlsx)
+            cache_setup.write_summary(fpho_df, output_filtered)
+            print('Filtered data has been saved to ' + output_filtered)
+        elif config['write_xlsx'] is True and config['normalize_data'] is True:
+            cache_setup.write_summary(fpho_df, output_xlsx)
+            print(key, 'has been updated to include normalized data')
         
         # Plots behavior
         if config['plot_behavior'] is True:
-            behavior_setup.plot_behavior(fpho_df, key, config['all_signals'])
+            behavior_setup.plot_behavior(
+                fpho_df, key, config['all_signals'],
+                config.get('behavior_plot_width'),
+                config.get('behavior_small_spans', 'merge'))
 
         # Plot the discrete fourier transform of you're channels of interest
         if config['fourier_transform'] is True:
@@ -128,10 +219,15 @@ def main():
 
         # Plots z-score analysis of behavior if specified
         if config['plot_zscore'] is True:
-            behavior_setup.plot_zscore(fpho_df, key, config['all_signals'], config['zscore_behs'])
+            behavior_setup.plot_zscore(
+                fpho_df, key, config['all_signals'], config['zscore_behs'],
+                config.get('zscore_pre', 1), config.get('zscore_post', 5),
+                config.get('zscore_baseline', 'clip'),
+                config.get('zscore_baseline_window', [4, 3]))
 
         if config['within_trial_pearsons'] is True:
-            print(correlation_setup.within_trial_pearsons(fpho_df, key, config['channels']))
+            print(correlation_setup.within_trial_pearsons(
+                fpho_df, key, config['channels']))
 
         if config['behavior_specific_pearsons'] is True:
             print(correlation_setup.behavior_specific_pearsons(fpho_df, key, config['channels'], config['behaviors'])) 
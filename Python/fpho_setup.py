@@ -1,28 +1,88 @@
 """Library of functions for fpho_driver
-    * import_fpho_data - saves data from csv in lists
+    * import_fpho_data - saves data from csv in a dataframe
+    * read_bonsai_csv - reads the needed columns of a Bonsai csv
+    * is_bonsai_csv - checks if a file has a Bonsai header
+    * read_legacy_csv - reads a headerless signal file and its timestamps
+    * legacy_flags - assigns LED flags to frames from their timestamps
+    * nearest_index - finds the nearest reference time for each time
+    * demux_frames - assigns frames to channels by their LED flag
+    * estimate_frame_interval - expected time between frames
+    * group_cycles - groups frames into cycles, finds frame drops
+    * frame_drop_report - describes each dropped or duplicated frame
+    * demux_cycles - assigns frames to channels, removing frame drops
+    * stream_fpho_data - reads and demultiplexes a csv in chunks
+    * session_info - returns per-session metadata
+    * store_fit_parameters - stores fit parameters once per session
     * raw_signal_trace - plots raw signal from fpho data
     * fit_exp - finds fitted exponent
+    * fit_exp_jacobian - derivatives of fit_exp by its parameters
+    * biexponential_p0 - estimates starting parameters of fit_exp
+    * block_average - averages a trace over blocks of samples
+    * fit_biexponential - fits fit_exp to a trace
+    * fit_biexponential_coarse - fits fit_exp to a block averaged trace
+    * rolling_percentile_baseline - rolling percentile baseline
+    * moving_minimum_baseline - smoothed moving minimum baseline
+    * lowpass_baseline - zero-phase low-pass baseline
+    * als_baseline - asymmetric least squares baseline
+    * fit_channel - fits the baseline of one channel
+    * fit_linear - closed-form bounded and robust linear fit
+    * normalize - normalizes a signal to a reference, without plotting
+    * normalize_channels - normalizes channels of a session
+    * add_columns - adds many columns to a session at once
+    * filter_channels - zero-phase filtering and decimation of signals
+    * delta_f - dF/F of a trace
+    * zscore - z-score of a trace
+    * rolling_zscore - z-score of a trace within a moving window
+    * transform_channels - adds dF/F and z-scores of normalized signals
     * plot_fitted_exp - plots 1 fiber normalized fitted exponenent
     * plot_isosbestic_norm - plots 1 fiber normalized isosbestic fit
 """
 
 import sys
+import copy
 from statistics import mean
 import pandas as pd
 import numpy as np
 import matplotlib.pyplot as plt
 import datetime
-from scipy.optimize import curve_fit
+from scipy.optimize import curve_fit, least_squares
 from scipy import stats
+from scipy.signal import butter, sosfiltfilt
+from scipy.linalg import solveh_banded
+from scipy.ndimage import minimum_filter1d, uniform_filter1d
 import csv
 import plotly.graph_objects as go
+from concurrent.futures import ProcessPoolExecutor
+import cache_setup
 
 driver_version = 'v4.0'
 
+# LED flags written by Bonsai for each excitation wavelength
+ISO_FLAG = 17
+GREEN_FLAG = 18
+RED_FLAG = 20
+
+# Number of leading frames the expected time between frames is
+# estimated from, the same for in-memory and chunked imports
+FRAME_INTERVAL_FRAMES = 1000
+
+# Increase when read_bonsai_csv, read_legacy_csv, demux_frames,
+# group_cycles, legacy_flags or the columns they build change, so
+# cached sessions are parsed again
+IMPORT_VERSION = 1
+
+# Increase when fit_biexponential, biexponential_p0, fit_linear or
+# their least_squares settings change, so cached fits are fitted again
+FIT_VERSION = 1
+
 
 def import_fpho_data(input_filename, output_filename, f1greencol, 
                      f1redcol, f2greencol, f2redcol,
-                     animal_ID, exp_date, exp_desc, frameshift, framedrops):
+                     animal_ID, exp_date, exp_desc, frameshift=False,
+                     framedrops=None, chunksize=None, cache_dir=None,
+                     compact=False, float32=False, engine=None,
+                     timestamp_filename=None, first_flag=GREEN_FLAG,
+                     max_sessions=20):
     """Takes a file name, returns a dataframe of parsed data
 
         Parameters
@@ -45,6 +105,38 @@ def import_fpho_data(input_filename, output_filename, f1greencol,
                 date data was gathered
         exp_desc: string
                 brief description of data
+        frameshift: boolean
+                if True, dropped and duplicated frames are found from
+                the Flags and Timestamp columns with demux_cycles and
+                the cycles they break are removed. The frame drop
+                report is stored in fdata.attrs['frame drops'], with
+                the sample of the session at each drop
+        framedrops: integer or None
+                expected number of frame drops, a warning is printed
+                if a different number is found
+        chunksize: integer or None
+                if given, the file is read this many rows at a time
+                with stream_fpho_data instead of all at once
+        cache_dir: string or None
+                if given, the parsed data is cached in this directory
+                and reused while the file and parameters are unchanged
+        compact: boolean
+                if True, animalID, date and description are stored
+                once in fdata.attrs instead of in a column per sample
+        float32: boolean
+                if True, channel values are stored as 32 bit floats
+        engine: 'pyarrow', 'c' or None
+                csv parser, see read_bonsai_csv
+        timestamp_filename: string or None
+                companion timestamp file of a headerless signal file,
+                the nearest row of it is stored for each green frame
+                in the VideoFrame column. See read_legacy_csv
+        first_flag: integer
+                LED flag of the first frame of a headerless signal
+                file, which has no Flags column
+        max_sessions: integer
+                number of sessions kept in cache_dir, the least
+                recently used sessions are removed
 
        Returns:
         --------
@@ -63,6 +155,14 @@ def import_fpho_data(input_filename, output_filename, f1greencol,
                            animal_ID, exp_date, exp_desc
         * Note: only one of these will be returned, depending
                 on if data is for one or two fiber
+        * Note: animal_ID, exp_date and exp_desc are in fdata.attrs
+                instead of columns when compact is True
+        * Note: fdata.attrs['start time'] is the Timestamp of the
+                first frame in seconds, fTime columns are relative
+                to it
+        * Note: files without a Flags header are read with
+                read_legacy_csv, always all at once since the file
+                is memory mapped
         """
 
     # Change None string to None keyword
@@ -80,149 +180,720 @@ def import_fpho_data(input_filename, output_filename, f1greencol,
         print("\nError: f1green or f1red column index not entered as integer")
         sys.exit()
 
-    if (f1greencol == f1redcol) or (f1greencol == f2greencol) or (f1greencol == f2redcol) or (f2greencol == f1redcol) or (f2greencol == f2redcol) or (f1redcol == f2redcol):
-        print("\nThe same column index has been assigned to two different colors or fibers.\n")
-        sys.exit()
-
     if f2greencol is not None:
-        # Catch error: f2green col entry not integer
+        # Catch error: f2green or f2red col entry missing or not integer
         try:
             f2greencol = int(f2greencol)
-        except ValueError:
-            print("\nError: f2green column index not entered as integer")
+            f2redcol = int(f2redcol)
+        except (TypeError, ValueError):
+            print("\nError: f2green or f2red column index not entered "
+                  "as integer")
             sys.exit(1)
-            
-        if f2greencol == f2redcol:
-            print("\nThe same column index is listed for f2green and f2red. "
-                  + "Input data contains", n_columns, "columns.\n")
-            sys.exit(1)
-    
+
+    # Unused fiber 2 columns are None and may repeat
+    used_cols = [col for col in (f1greencol, f1redcol, f2greencol, f2redcol)
+                 if col is not None]
+    if len(set(used_cols)) < len(used_cols):
+        print("\nThe same column index has been assigned to two different "
+              "colors or fibers.\n")
+        sys.exit()
+
+    # Column index of each fiber and color in the Bonsai file
+    channel_cols = {'f1Green': f1greencol, 'f1Red': f1redcol}
+    if f2greencol is not None:
+        channel_cols['f2Green'] = f2greencol
+        channel_cols['f2Red'] = f2redcol
+
     # Open file, catch errors
     try:
-        file = pd.read_csv(input_filename)
-    except FileNotFoundError:
-        print("Could not find file: " + input_filename)
+        legacy = not is_bonsai_csv(input_filename)
+        if legacy:
+            chunksize = None
+        if cache_dir is not None:
+            params = {}
+            if legacy:
+                params['first_flag'] = first_flag
+                if timestamp_filename is not None:
+                    params['timestamps'] = cache_setup.file_hash(
+                        timestamp_filename)
+            key = cache_setup.cache_key(input_filename, dict(params, **{
+                'reader': 'legacy_csv' if legacy else 'bonsai_csv',
+                'import_version': IMPORT_VERSION,
+                'driver_version': driver_version,
+                'channel_cols': channel_cols,
+                'animal_ID': animal_ID,
+                'exp_date': exp_date,
+                'exp_desc': exp_desc,
+                'frameshift': frameshift,
+                'framedrops': framedrops,
+                'compact': compact,
+                'float32': float32,
+                'engine': engine}))
+            fdata = cache_setup.load_session(cache_dir, key)
+            if fdata is not None:
+                print('data was loaded from the cache for', input_filename)
+                return fdata
+        if legacy:
+            file = read_legacy_csv(input_filename, channel_cols,
+                                   timestamp_filename, first_flag)
+        elif chunksize is None:
+            file = read_bonsai_csv(input_filename, channel_cols,
+                                   engine=engine)
+        else:
+            blocks = []
+            reports = []
+            for block, report in stream_fpho_data(
+                    input_filename, channel_cols, chunksize,
+                    fix_drops=frameshift, engine=engine):
+                blocks.append(block)
+                reports.append(report)
+            if len(blocks) == 0:
+                print("\nError: no green frames (Flags = 18) found in "
+                      "a complete cycle of the data")
+                sys.exit(1)
+            report = pd.concat(reports, ignore_index=True)
+            first_row = next(read_bonsai_csv(input_filename, channel_cols,
+                                             chunksize=1, engine=engine))
+            start_time = first_row['Timestamp'].iloc[0]
+    except FileNotFoundError as error:
+        print("Could not find file: " + str(error.filename))
         sys.exit(1)
-    except PermissionError:
-        print("Could not access file: " + input_filename)
+    except PermissionError as error:
+        print("Could not access file: " + str(error.filename))
         sys.exit(2)
-    
-    # Ensures start index is on green (green flagged as 18)
-    start_idx=301 # cut off first ~300 entries
-    start_is_not_green = True
-    while(start_is_not_green):
-        if file["Flags"][start_idx] == 18:
-            start_is_not_green = False
-        if file["Flags"][start_idx] == 20:
-            start_is_not_green = True
-            start_idx=start_idx+1
-        if file["Flags"][start_idx] == 17:
-            start_is_not_green = True
-            start_idx=start_idx+1
-    
-    # Find min data length
-    file['Timestamp']=(file['Timestamp']-file['Timestamp'][0])
-    length=len(file['Flags'])-1
-    values=length-start_idx
-    extras=values%3
-    min=int(length-extras)
-    
+
+    if chunksize is None:
+        flags = file['Flags'].to_numpy()
+        # Timestamps relative to the first frame
+        time = file['Timestamp'].to_numpy()
+        start_time = time[0]
+        time = time - start_time
+
+        # Assign every frame to a light channel using its LED flag
+        if frameshift:
+            green_idx, red_idx, iso_idx, report = demux_cycles(flags, time)
+        else:
+            green_idx, red_idx, iso_idx = demux_frames(flags)
+
+        channels = {'fTimeIso': time[iso_idx],
+                    'fTimeRed': time[red_idx],
+                    'fTimeGreen': time[green_idx]}
+        for name in channel_cols:
+            values = file[name].to_numpy()
+            channels[name + 'Green'] = values[green_idx]
+            channels[name + 'Iso'] = values[iso_idx]
+            channels[name + 'Red'] = values[red_idx]
+        if 'VideoFrame' in file:
+            channels['VideoFrame'] = file['VideoFrame'].to_numpy()[green_idx]
+    else:
+        channels = {key: np.concatenate([block[key] for block in blocks])
+                    for key in blocks[0]}
+
+    if frameshift and len(report) > 0:
+        print(len(report), 'cycles with dropped or duplicated frames were '
+              'removed from', input_filename)
+        print(report.to_string(index=False))
+    if frameshift and framedrops is not None:
+        if len(report) != framedrops:
+            print('Warning: framedrops is', framedrops, 'in config.yml but',
+                  len(report), 'frame drops were found')
+
+    # Timestamps stay float64, 32 bit floats are too coarse for long sessions
+    if float32:
+        for name in channel_cols:
+            for color in ['Green', 'Iso', 'Red']:
+                channels[name + color] = channels[name + color].astype(
+                    np.float32)
+
     # Create dictionary containing parsed values
-    data_dict = {'animalID': [animal_ID]*(int((min-start_idx)/3)),
-                 'date': [exp_date]*(int((min-start_idx)/3)),
-                 'description': [exp_desc]*(int((min-start_idx)/3)),
-                 'fTimeIso': file.iloc[start_idx+2:min:3, 1].values.tolist(),
-                 'fTimeRed': file.iloc[start_idx+1:min:3, 1].values.tolist(),
-                 'fTimeGreen': file.iloc[start_idx:min:3, 1].values.tolist(),
-                 'f1GreenGreen': file.iloc[start_idx:min:3, f1greencol].values.tolist(),
-                 'f1GreenIso': file.iloc[start_idx+2:min:3, f1greencol].values.tolist(),
-                 'f1GreenRed': file.iloc[start_idx+1:min:3, f1greencol].values.tolist(),
-                 'f1RedGreen': file.iloc[start_idx:min:3, f1greencol].values.tolist(),
-                 'f1RedRed':file.iloc[start_idx+1:min:3, f1redcol].values.tolist(),
-                 'f1RedIso': file.iloc[start_idx+2:min:3, f1redcol].values.tolist()}
-                 
-    
-    # Add additional columns if 2 fiber
-    if f2greencol != None:
-        data_dict['f2GreenGreen'] = file.iloc[start_idx:min:3, f2greencol].values.tolist()
-        data_dict['f2GreenIso'] = file.iloc[start_idx+2:min:3, f2greencol].values.tolist()
-        data_dict['f2GreenRed'] = file.iloc[start_idx+1:min:3, f2greencol].values.tolist()
-        data_dict['f2RedRed'] = file.iloc[start_idx+1:min:3, f2redcol].values.tolist()
-        data_dict['f2RedIso'] = file.iloc[start_idx+2:min:3, f2redcol].values.tolist()
-        data_dict['f2RedGreen'] = file.iloc[start_idx:min:3, f2redcol].values.tolist()
-        
-    # Correct for frame shifts
-    if frameshift == True:
-        data_dict = fix_frame_shift(data_dict, framedrops) # get frame drops and T/F from config.yml
+    info = {'animalID': animal_ID,
+            'date': exp_date,
+            'description': exp_desc}
+    data_dict = {} if compact else dict(info)
+    data_dict.update(channels)
 
     # Convert dictionary to pandas dataframe and return
     fdata=pd.DataFrame.from_dict(data_dict)
+    if compact:
+        fdata.attrs.update(info)
+        fdata.attrs['compact'] = True
+    # Clock time of the first frame, to align the session with video
+    fdata.attrs['start time'] = float(start_time)
+    if frameshift:
+        # Sample of the session at each drop, the first cycle after it
+        report['sample'] = fdata['fTimeGreen'].searchsorted(
+            report['Timestamp'])
+        fdata.attrs['frame drops'] = report.to_dict(orient='list')
+    if cache_dir is not None:
+        cache_setup.save_session(fdata, cache_dir, key, max_sessions)
     return fdata
-    
-    
-def fix_frame_shift(data_dict, framedrops):
-   # Frame Drop Correction
-    # if: 1 frame drop
-        # drop jump idx frame, match the ones before the jump and after the jump idx
-        # all lists in dict need to be the same len (be careful when dropping/replacing the frame, out of time, etc)
-    # else: 2 frame drop
-    for j in range(framedrops):
-        i=0
-        jump=0
-        jumpIdx=-1
-        while i < len(data_dict['f1GreenGreen'])-2:
-            distanceFromNext=abs(data_dict['f1GreenGreen'][i] - data_dict['f1GreenGreen'][i+1])
-            distanceFromIso=abs(data_dict['f1GreenGreen'][i] - data_dict['f1GreenIso'][i+1])
-            if distanceFromNext>distanceFromIso and distanceFromNext>jump:
-                jump=distanceFromNext
-                jumpIdx=i
-            i=i+1
-
-        if jump>0:
-            
-            if abs(data_dict['f1GreenGreen'][jumpIdx] - data_dict['f1GreenIso'][jumpIdx+3]) < abs(data_dict['f1GreenIso'][jumpIdx] - data_dict['f1GreenGreen'][jumpIdx+3]):
-                temp=data_dict['f1GreenGreen'][jumpIdx+1:]
-                data_dict['f1GreenGreen'][jumpIdx+1:]=data_dict['f1GreenIso'][jumpIdx+1:]
-                data_dict['f1GreenIso'][jumpIdx+1:]=data_dict['f1GreenRed'][jumpIdx+1:]
-                data_dict['f1GreenRed'][jumpIdx+1:]=temp
-
-                temp=data_dict['f1RedIso'][jumpIdx+1:]
-                data_dict['f1RedIso'][jumpIdx+1:]=data_dict['f1RedRed'][jumpIdx+1:]
-                data_dict['f1RedRed'][jumpIdx+1:]=data_dict['f1RedGreen'][jumpIdx+1:]
-                data_dict['f1RedGreen'][jumpIdx+1:]=temp
-                
-                if f2greencol != None:
-                    temp=data_dict['f2GreenGreen'][jumpIdx+1:]
-                    data_dict['f2GreenGreen'][jumpIdx+1:]=data_dict['f2GreenIso'][jumpIdx+1:]
-                    data_dict['f2GreenIso'][jumpIdx+1:]=data_dict['f2GreenRed'][jumpIdx+1:]
-                    data_dict['f2GreenRed'][jumpIdx+1:]=temp
-
-                    temp=data_dict['f2RedIso'][jumpIdx+1:]
-                    data_dict['f2RedIso'][jumpIdx+1:]=data_dict['f2RedRed'][jumpIdx+1:]
-                    data_dict['f2RedRed'][jumpIdx+1:]=data_dict['f2RedGreen'][jumpIdx+1:]
-                    data_dict['f2RedGreen'][jumpIdx+1:]=temp
-            else:
-                temp=data_dict['f1GreenIso'][jumpIdx+1:]
-                data_dict['f1GreenIso'][jumpIdx+1:]=data_dict['f1GreenGreen'][jumpIdx+1:]
-                data_dict['f1GreenGreen'][jumpIdx+1:]=data_dict['f1GreenRed'][jumpIdx+1:]
-                data_dict['f1GreenRed'][jumpIdx+1:]=temp
-
-                temp=data_dict['f1RedRed'][jumpIdx+1:]
-                data_dict['f1RedRed'][jumpIdx+1:]=data_dict['f1RedIso'][jumpIdx+1:]
-                data_dict['f1RedIso'][jumpIdx+1:]=data_dict['f1RedGreen'][jumpIdx+1:]
-                data_dict['f1RedGreen'][jumpIdx+1:]=temp
-                
-                if f2greencol != None:
-                    temp=data_dict['f2GreenIso'][jumpIdx+1:]
-                    data_dict['f2GreenIso'][jumpIdx+1:]=data_dict['f2GreenGreen'][jumpIdx+1:]
-                    data_dict['f2GreenGreen'][jumpIdx+1:]=data_dict['f2GreenRed'][jumpIdx+1:]
-                    data_dict['f2GreenRed'][jumpIdx+1:]=temp
-
-                    temp=data_dict['f2RedRed'][jumpIdx+1:]
-                    data_dict['f2RedRed'][jumpIdx+1:]=data_dict['f2RedIso'][jumpIdx+1:]
-                    data_dict['f2RedIso'][jumpIdx+1:]=data_dict['f2RedGreen'][jumpIdx+1:]
-                    data_dict['f2RedGreen'][jumpIdx+1:]=temp
-    return(data_dict)
+
+
+def read_bonsai_csv(input_filename, channel_cols, chunksize=None,
+                    engine=None):
+    """Reads only the Timestamp, Flags and channel columns of a Bonsai file
+
+        Parameters
+        ----------
+        input_filename: string
+                The path to the CSV file
+        channel_cols: dictionary
+                column index for each fiber and color,
+                e.g. {'f1Green': 9, 'f1Red': 5}
+        chunksize: integer or None
+                if given, an iterator over chunks of this many rows
+                is returned
+        engine: 'pyarrow', 'c' or None
+                csv parser, None picks pyarrow when it is installed.
+                pyarrow cannot read in chunks, so chunks are read by
+                the c parser with round_trip float parsing, which
+                gives the same values as pyarrow
+
+        Returns:
+        --------
+        file: pandas dataframe or iterator of dataframes
+                float64 columns Timestamp, Flags and one column per
+                key of channel_cols, in that order
+    """
+    header = pd.read_csv(input_filename, nrows=0).columns
+    for name, col in channel_cols.items():
+        if not 0 <= col < len(header):
+            print("\nError: column index", col, "for", name,
+                  "is not in the file, which has", len(header), "columns")
+            sys.exit(1)
+    names = {header[col]: name for name, col in channel_cols.items()}
+
+    # Flags are read as floats so a partly written final row is not
+    # an error, that frame is discarded anyway
+    dtype = {'Timestamp': np.float64, 'Flags': np.float64}
+    dtype.update({column: np.float64 for column in names})
+
+    if engine is None:
+        try:
+            import pyarrow
+            engine = 'pyarrow'
+        except ImportError:
+            engine = 'c'
+    options = {}
+    if chunksize is not None:
+        if engine == 'pyarrow':
+            options['float_precision'] = 'round_trip'
+        engine = 'c'
+
+    # The parsers differ in column order, so it is fixed here
+    columns = ['Timestamp', 'Flags'] + list(channel_cols)
+    file = pd.read_csv(input_filename, usecols=list(dtype), dtype=dtype,
+                       engine=engine, chunksize=chunksize, **options)
+    if chunksize is None:
+        return file.rename(columns=names)[columns]
+    return (chunk.rename(columns=names)[columns] for chunk in file)
+
+
+def is_bonsai_csv(input_filename):
+    """Returns True if the first line of a file is a Bonsai header"""
+    with open(input_filename) as f:
+        header = f.readline()
+    return 'Flags' in header.replace(' ', ',').split(',')
+
+
+def read_legacy_csv(input_filename, channel_cols, timestamp_filename=None,
+                    first_flag=GREEN_FLAG, time_col=0, time_scale=1e-3):
+    """Reads a headerless, space delimited signal file from older rigs
+
+        The file is memory mapped and parsed by the c parser straight
+        into float64 arrays. These files have no Flags column, so the
+        LED of each frame is found from its timestamp with legacy_flags
+
+        Parameters
+        ----------
+        input_filename: string
+                The path to the signal file, one frame per line with
+                the time in ms, a frame counter and the ROI values
+        channel_cols: dictionary
+                column index for each fiber and color,
+                e.g. {'f1Green': 2, 'f1Red': 3}
+        timestamp_filename: string or None
+                companion file with one timestamp in ms per line,
+                e.g. the video frame times of the session
+        first_flag: integer
+                LED flag of the first frame
+        time_col: integer
+                column index of the timestamps
+        time_scale: float
+                seconds per timestamp unit
+
+        Returns:
+        --------
+        file: pandas dataframe
+                float64 columns Timestamp (in seconds), Flags and one
+                column per key of channel_cols, in that order. With a
+                timestamp file, VideoFrame holds the row of the
+                nearest companion timestamp for each frame
+    """
+    with open(input_filename) as f:
+        n_columns = len(f.readline().split())
+    for name, col in channel_cols.items():
+        if not 0 <= col < n_columns or col == time_col:
+            print("\nError: column index", col, "for", name,
+                  "is not a signal column of the file, which has",
+                  n_columns, "columns")
+            sys.exit(1)
+
+    # Lines end with a space, so the separator is any whitespace
+    columns = [time_col] + list(channel_cols.values())
+    signal = pd.read_csv(input_filename, sep=r'\s+', header=None,
+                         usecols=columns, dtype=np.float64,
+                         memory_map=True)
+    raw_time = signal[time_col].to_numpy()
+
+    file = {'Timestamp': raw_time * time_scale,
+            'Flags': legacy_flags(raw_time, first_flag)}
+    for name, col in channel_cols.items():
+        file[name] = signal[col].to_numpy()
+    if timestamp_filename is not None:
+        # Both files use the same clock, so they are joined before
+        # the timestamps are scaled
+        reference = pd.read_csv(timestamp_filename, sep=r'\s+',
+                                header=None, usecols=[0],
+                                dtype=np.float64, memory_map=True)
+        file['VideoFrame'] = nearest_index(reference[0].to_numpy(),
+                                           raw_time)
+    return pd.DataFrame(file)
+
+
+def legacy_flags(time, first_flag=GREEN_FLAG):
+    """Assigns a Bonsai LED flag to each frame from its timestamp
+
+        Each gap between frames is rounded to a whole number of frame
+        intervals, so a dropped frame moves the LED order on by one
+        and timing jitter does not add up over long sessions
+
+        Parameters
+        ----------
+        time: numpy array
+                frame timestamps, in any unit
+        first_flag: integer
+                LED flag of the first frame
+
+        Returns:
+        --------
+        flags: numpy array
+                float64 flags in the Bonsai order green, red, iso
+    """
+    order = np.array([GREEN_FLAG, RED_FLAG, ISO_FLAG], dtype=np.float64)
+    if first_flag not in order:
+        print("\nError: first_flag must be", ISO_FLAG, GREEN_FLAG,
+              "or", RED_FLAG)
+        sys.exit(1)
+    if len(time) < 2:
+        return np.full(len(time), float(first_flag))
+    gaps = np.diff(time)
+    steps = np.rint(gaps / np.median(gaps)).astype(np.int64)
+    frames = np.concatenate(([0], np.cumsum(steps)))
+    start = int(np.flatnonzero(order == first_flag)[0])
+    return order[(frames + start) % 3]
+
+
+def nearest_index(reference, times):
+    """Returns the index of the nearest reference time for each time
+
+        Parameters
+        ----------
+        reference: numpy array
+                sorted reference times
+        times: numpy array
+                times to look up
+
+        Returns:
+        --------
+        index: numpy array
+                integer index into reference for each time
+    """
+    if len(reference) == 1:
+        return np.zeros(len(times), dtype=np.int64)
+    index = np.searchsorted(reference, times)
+    index = np.clip(index, 1, len(reference) - 1)
+    # Step back where the earlier neighbour is closer
+    index -= (times - reference[index - 1]) < (reference[index] - times)
+    return index
+
+
+def demux_frames(flags, start_idx=301):
+    """Assigns each Bonsai frame to a light channel using its Flags value
+
+        Parameters
+        ----------
+        flags: numpy array
+                Flags column of the Bonsai file
+                (17 = isosbestic, 18 = green, 20 = red)
+        start_idx: integer
+                frames before this index are discarded
+
+        Returns:
+        --------
+        green_idx, red_idx, iso_idx: numpy arrays
+                row indices of the green, red and isosbestic frames,
+                trimmed to the complete cycles that start on green
+    """
+    flags = np.asarray(flags)
+    # The final frame is always discarded
+    end = len(flags) - 1
+
+    greens = np.flatnonzero(flags[start_idx:end] == GREEN_FLAG)
+    if len(greens) == 0:
+        print("\nError: no green frames (Flags = 18) found in the data")
+        sys.exit(1)
+
+    rows = np.arange(start_idx + greens[0], end)
+    row_flags = flags[rows]
+    green_idx = rows[row_flags == GREEN_FLAG]
+    red_idx = rows[row_flags == RED_FLAG]
+    iso_idx = rows[row_flags == ISO_FLAG]
+
+    n_cycles = min(len(green_idx), len(red_idx), len(iso_idx))
+    return green_idx[:n_cycles], red_idx[:n_cycles], iso_idx[:n_cycles]
+
+
+def estimate_frame_interval(time, n_frames=FRAME_INTERVAL_FRAMES):
+    """Returns the median time between the first n_frames frames
+
+        Parameters
+        ----------
+        time: numpy array
+                timestamps of consecutive frames
+        n_frames: integer
+                number of leading frames used, so the estimate does
+                not depend on how much of the file has been read
+    """
+    return np.median(np.diff(time[:n_frames]))
+
+
+def group_cycles(flags, time, frame_interval=None, truncated=True):
+    """Groups consecutive frames into green, red, iso cycles
+
+        A cycle starts at every green frame and after every gap in
+        the timestamps, so a dropped frame breaks only the cycle it
+        falls in. Broken cycles are removed instead of shifting the
+        phase of every frame after them.
+
+        Parameters
+        ----------
+        flags: numpy array
+                Flags of consecutive frames, starting on green
+        time: numpy array
+                timestamps of the same frames
+        frame_interval: float or None
+                expected time between frames, estimated from the
+                leading frames when None (see estimate_frame_interval).
+                Intervals over 1.5 times this are gaps
+        truncated: boolean
+                if True, a short final cycle is taken to be cut off
+                by the end of the data and is not reported as a drop
+
+        Returns:
+        --------
+        green_idx, red_idx, iso_idx: numpy arrays
+                positions of the frames of every complete cycle
+        drops: numpy array
+                positions where each broken cycle starts
+        lengths: numpy array
+                number of frames in each broken cycle
+    """
+    if frame_interval is None:
+        frame_interval = estimate_frame_interval(time)
+    starts = flags == GREEN_FLAG
+    starts[1:] |= np.diff(time) > 1.5 * frame_interval
+    starts = np.flatnonzero(starts)
+    lengths = np.diff(np.append(starts, len(flags)))
+
+    complete = lengths == 3
+    first = starts[complete]
+    complete[complete] = ((flags[first] == GREEN_FLAG)
+                          & (flags[first + 1] == RED_FLAG)
+                          & (flags[first + 2] == ISO_FLAG))
+    if truncated and len(starts) > 0 and lengths[-1] < 3:
+        starts, lengths, complete = starts[:-1], lengths[:-1], complete[:-1]
+
+    green_idx = starts[complete]
+    return (green_idx, green_idx + 1, green_idx + 2,
+            starts[~complete], lengths[~complete])
+
+
+def frame_drop_report(flags, time, drops, lengths, first_row=0, slip=0):
+    """Describes each drop of one or more frames found by group_cycles
+
+        Parameters
+        ----------
+        flags, time: numpy arrays
+                Flags and timestamps passed to group_cycles
+        drops, lengths: numpy arrays
+                broken cycles returned by group_cycles
+        first_row: integer
+                file row of the first frame in flags
+        slip: integer
+                frames gained or lost before the first frame in flags
+
+        Returns:
+        --------
+        report: pandas dataframe
+                containing row, Timestamp, Flags (the flags of the
+                broken cycle, e.g. '18-17'), frames (number of frames
+                in it) and phase (offset of the following frames from
+                the 3 frame cycle of the start of the recording)
+    """
+    # A gap in the timestamps also starts a cycle, so a broken cycle
+    # that directly follows another and does not start on green is
+    # part of the same drop
+    if len(drops) > 0:
+        new_drop = flags[drops] == GREEN_FLAG
+        new_drop[0] = True
+        new_drop[1:] |= drops[1:] != drops[:-1] + lengths[:-1]
+        lengths = np.add.reduceat(lengths, np.flatnonzero(new_drop))
+        drops = drops[new_drop]
+
+    flag_runs = ['-'.join('%d' % flag for flag in flags[start:start + length])
+                 for start, length in zip(drops, lengths)]
+    return pd.DataFrame({'row': drops + first_row,
+                         'Timestamp': time[drops],
+                         'Flags': flag_runs,
+                         'frames': lengths,
+                         'phase': (slip + np.cumsum(lengths - 3)) % 3})
+
+
+def demux_cycles(flags, time, start_idx=301, frame_interval=None):
+    """Assigns frames to channels, removing cycles with dropped frames
+
+        Parameters
+        ----------
+        flags: numpy array
+                Flags column of the Bonsai file
+        time: numpy array
+                Timestamp column of the Bonsai file
+        start_idx: integer
+                frames before this index are discarded
+        frame_interval: float or None
+                expected time between frames, see group_cycles
+
+        Returns:
+        --------
+        green_idx, red_idx, iso_idx: numpy arrays
+                row indices of the frames of every complete cycle
+        report: pandas dataframe
+                every broken cycle, see frame_drop_report
+    """
+    flags = np.asarray(flags)
+    # The final frame is always discarded
+    end = len(flags) - 1
+
+    greens = np.flatnonzero(flags[start_idx:end] == GREEN_FLAG)
+    if len(greens) == 0:
+        print("\nError: no green frames (Flags = 18) found in the data")
+        sys.exit(1)
+
+    first = start_idx + greens[0]
+    green_idx, red_idx, iso_idx, drops, lengths = group_cycles(
+        flags[first:end], time[first:end], frame_interval)
+    report = frame_drop_report(flags[first:end], time[first:end], drops,
+                               lengths, first_row=first)
+    return green_idx + first, red_idx + first, iso_idx + first, report
+
+
+def stream_fpho_data(input_filename, channel_cols, chunksize,
+                     start_idx=301, fix_drops=False, frame_interval=None,
+                     engine=None):
+    """Reads a Bonsai file in chunks, yields demultiplexed blocks
+
+        Frames are assigned to channels exactly as in demux_frames, or
+        as in demux_cycles when fix_drops is True. Frames of an
+        incomplete cycle are carried over to the next chunk, so the
+        concatenated blocks match the in-memory import.
+
+        Parameters
+        ----------
+        input_filename: string
+                The path to the CSV file
+        channel_cols: dictionary
+                column index for each fiber and color,
+                e.g. {'f1Green': 9, 'f1Red': 5}
+        chunksize: integer
+                number of rows read at a time
+        start_idx: integer
+                frames before this index are discarded
+        fix_drops: boolean
+                if True, cycles broken by dropped frames are removed
+        frame_interval: float or None
+                expected time between frames, estimated from the
+                first FRAME_INTERVAL_FRAMES frames after start_idx
+                when None, as in demux_cycles
+        engine: 'pyarrow', 'c' or None
+                csv parser, see read_bonsai_csv
+
+        Yields:
+        --------
+        block: dictionary
+                numpy arrays for fTimeIso, fTimeRed, fTimeGreen and
+                the Green, Iso and Red channels of each column
+        report: pandas dataframe
+                every broken cycle in the block, see frame_drop_report.
+                Always empty when fix_drops is False
+    """
+    names = list(channel_cols)
+    n_cols = len(names) + 1
+    no_drops = frame_drop_report(np.empty(0), np.empty(0),
+                                 np.empty(0, dtype=np.int64),
+                                 np.empty(0, dtype=np.int64))
+    slip = 0
+    # Unpaired frames (timestamp and channel values) for each LED
+    pending = {flag: np.empty((0, n_cols))
+               for flag in (GREEN_FLAG, RED_FLAG, ISO_FLAG)}
+    # Frames of the cycle that may continue into the next chunk
+    carry_flags = np.empty(0)
+    carry_rows = np.empty((0, n_cols))
+    carry_first = 0
+    held_flags = np.empty(0)
+    held_rows = np.empty((0, n_cols))
+    first_time = None
+    first_row = 0
+    started = False
+
+    for chunk in read_bonsai_csv(input_filename, channel_cols, chunksize,
+                                 engine):
+        rows = np.empty((len(chunk), n_cols))
+        rows[:, 0] = chunk['Timestamp'].to_numpy()
+        for j, name in enumerate(names):
+            rows[:, j + 1] = chunk[name].to_numpy()
+        if first_time is None:
+            first_time = rows[0, 0]
+        rows[:, 0] -= first_time
+
+        # The final frame of the file is always discarded, so the last
+        # frame of each chunk is held back until the next one arrives
+        flags = np.concatenate([held_flags, chunk['Flags'].to_numpy()])
+        rows = np.concatenate([held_rows, rows])
+        held_flags, held_rows = flags[-1:], rows[-1:]
+        flags, rows = flags[:-1], rows[:-1]
+
+        keep = np.arange(first_row, first_row + len(flags)) >= start_idx
+        first_row += len(flags)
+        if not started:
+            greens = np.flatnonzero(keep & (flags == GREEN_FLAG))
+            if len(greens) == 0:
+                continue
+            keep[:greens[0]] = False
+            carry_first = first_row - len(flags) + greens[0]
+            started = True
+
+        if fix_drops:
+            flags = np.concatenate([carry_flags, flags[keep]])
+            rows = np.concatenate([carry_rows, rows[keep]])
+            if frame_interval is None:
+                # Wait for the frames the interval is estimated from,
+                # the end of the file is handled below
+                if len(rows) < FRAME_INTERVAL_FRAMES:
+                    carry_flags, carry_rows = flags, rows
+                    continue
+                frame_interval = estimate_frame_interval(rows[:, 0])
+            # The cycle starting at the last green frame may continue
+            # in the next chunk
+            last = np.flatnonzero(flags == GREEN_FLAG)[-1]
+            green, red, iso, drops, lengths = group_cycles(
+                flags[:last], rows[:last, 0], frame_interval,
+                truncated=False)
+            report = frame_drop_report(flags, rows[:, 0], drops, lengths,
+                                       first_row=carry_first, slip=slip)
+            slip += np.sum(lengths - 3)
+            yield (_channel_block(names, rows[green], rows[red], rows[iso]),
+                   report)
+            carry_flags, carry_rows = flags[last:], rows[last:]
+            carry_first += last
+            continue
+
+        for flag in pending:
+            pending[flag] = np.concatenate(
+                [pending[flag], rows[keep & (flags == flag)]])
+        n_cycles = min(len(frames) for frames in pending.values())
+        if n_cycles == 0:
+            continue
+
+        yield (_channel_block(names, pending[GREEN_FLAG][:n_cycles],
+                              pending[RED_FLAG][:n_cycles],
+                              pending[ISO_FLAG][:n_cycles]),
+               no_drops)
+        for flag in pending:
+            pending[flag] = pending[flag][n_cycles:]
+
+    if not started:
+        print("\nError: no green frames (Flags = 18) found in the data")
+        sys.exit(1)
+
+    if fix_drops and len(carry_flags) > 0:
+        green, red, iso, drops, lengths = group_cycles(
+            carry_flags, carry_rows[:, 0], frame_interval)
+        report = frame_drop_report(carry_flags, carry_rows[:, 0], drops,
+                                   lengths, first_row=carry_first, slip=slip)
+        yield (_channel_block(names, carry_rows[green], carry_rows[red],
+                              carry_rows[iso]),
+               report)
+
+
+def _channel_block(names, green, red, iso):
+    """Splits the green, red and iso frames of a block into channels
+
+        green, red and iso hold one row per cycle with the timestamp
+        followed by the value of each column in names.
+    """
+    block = {'fTimeIso': iso[:, 0],
+             'fTimeRed': red[:, 0],
+             'fTimeGreen': green[:, 0]}
+    for j, name in enumerate(names):
+        block[name + 'Green'] = green[:, j + 1]
+        block[name + 'Iso'] = iso[:, j + 1]
+        block[name + 'Red'] = red[:, j + 1]
+    return block
+
+
+def session_info(fdata, name):
+    """Returns per-session metadata such as animalID or date
+
+        Compact sessions keep it in fdata.attrs, older sessions
+        repeat it in a column on every row.
+    """
+    if name in fdata.attrs:
+        return fdata.attrs[name]
+    return fdata[name].iloc[0]
+
+
+def store_fit_parameters(fdata, column, params, columns=None):
+    """Stores the parameters of a fit once per session
+
+        Parameters
+        ----------
+        fdata: pandas dataframe
+                session the fit belongs to
+        column: string
+                name for the parameters, e.g. 'f1GreenGreen expfit
+                parameters'
+        params: dictionary
+                parameter values by name, e.g. {'A': 1.2, 'B': 0.3}
+        columns: dictionary or None
+                if given, the column is put in this dictionary to be
+                added to fdata later instead of being added now
+
+        Compact sessions keep the parameters in fdata.attrs[column],
+        otherwise they are written as 'A= 1.2' strings to the first
+        rows of an object column padded with 'na'.
+    """
+    if fdata.attrs.get('compact'):
+        fdata.attrs[column] = {key: float(value)
+                               for key, value in params.items()}
+    else:
+        values = np.full(len(fdata), 'na', dtype=object)
+        values[:len(params)] = [key + '= ' + str(value)
+                                for key, value in params.items()]
+        if columns is None:
+            fdata[column] = values
+        else:
+            columns[column] = values
 
 
 def raw_signal_trace(fdata, file):
@@ -318,103 +989,744 @@ def raw_signal_trace(fdata, file):
     return
 
 
-def plot_fitted_exp(fdata, file, signals, references):
-    import plotly.express as px
-    import plotly.graph_objects as go
-    from plotly.subplots import make_subplots
-    """Creates a plot normalizing 1 fiber data to an
-        exponential of the form y=A*exp(-B*X)+C*exp(-D*x)
+def sample_window(time, seconds):
+    """Returns the odd number of samples closest to a time window"""
+    interval = np.median(np.diff(time)) if len(time) > 1 else 1
+    samples = max(int(round(seconds / interval)), 1)
+    return samples + 1 - samples % 2
+
+
+def rolling_percentile_baseline(time, values, window=60, percentile=10):
+    """Baseline from a centered rolling percentile of the trace
 
         Parameters
         ----------
-        fpho_dataframe: string
-                pandas dataframe
-        output_filename: string
-                name for output csv
+        time: numpy array
+                time of each sample
+        values: numpy array
+                trace to detrend
+        window: float
+                window length in seconds, longer than any transient
+        percentile: float
+                percentile of each window, low values follow the
+                floor of the trace
+
         Returns:
         --------
-        output_filename_f1GreenNormExp.png
-        & output_filename_f1RedNormExp.png: png files
-                containing the normalized plot for each fluorophore
-    """
-    # Get coefficients for normalized fit using first guesses
-    # for the coefficients - B and D (the second and fourth
-    # inputs for p0) must be negative, while A and C (the
-    # first and third inputs for p0) must be positive
-    
-    for i in range(len(signals)):
-        popt, pcov = curve_fit(fit_exp, fdata['fTimeGreen'], fdata[signals[i]], p0=(1.0, 0, 1.0, 0, 0), bounds=(0,np.inf))
+        baseline: numpy array
+        params: dictionary
+                window and percentile
+    """
+    samples = sample_window(time, window)
+    baseline = pd.Series(values).rolling(
+        samples, center=True, min_periods=1).quantile(percentile / 100)
+    return baseline.to_numpy(), {'window': window, 'percentile': percentile}
 
-        AS = popt[0]  # A value
-        BS = popt[1]  # B value
-        CS = popt[2]  # C value
-        DS = popt[3]  # D value
-        ES = popt[4]
-        
-        popt, pcov = curve_fit(fit_exp, fdata['fTimeGreen'], fdata[references[i]], p0=(1.0, 0, 1.0, 0, 0), bounds=(0,np.inf))
 
-        AR = popt[0]  # A value
-        BR = popt[1]  # B value
-        CR = popt[2]  # C value
-        DR = popt[3]  # D value
-        ER = popt[4]       
+def moving_minimum_baseline(time, values, window=60):
+    """Baseline from the moving minimum of the trace, smoothed by a
+        moving average of the same window
 
-        # Generate fit line using calculated coefficients
-        fitSig = fit_exp(fdata['fTimeGreen'], AS, BS, CS, DS, ES)
-        fitRef = fit_exp(fdata['fTimeGreen'], AR, BR, CR, DR, ER)
-        
-        sigRsquare=np.corrcoef(fdata[signals[i]], fitSig)[0,1]**2
-        refRsquare=np.corrcoef(fdata[references[i]], fitRef)[0,1]**2
+        Parameters
+        ----------
+        time: numpy array
+                time of each sample
+        values: numpy array
+                trace to detrend
+        window: float
+                window length in seconds
+
+        Returns:
+        --------
+        baseline: numpy array
+        params: dictionary
+                window
+    """
+    samples = sample_window(time, window)
+    envelope = minimum_filter1d(values, samples, mode='nearest')
+    baseline = uniform_filter1d(envelope, samples, mode='nearest')
+    return baseline, {'window': window}
+
+
+def lowpass_baseline(time, values, cutoff=0.005, order=2):
+    """Baseline from a zero-phase Butterworth low-pass filter
+
+        Parameters
+        ----------
+        time: numpy array
+                time of each sample
+        values: numpy array
+                trace to detrend
+        cutoff: float
+                cutoff frequency in Hz, below the frequency of any
+                transient
+        order: integer
+                order of the filter
+
+        Returns:
+        --------
+        baseline: numpy array
+        params: dictionary
+                cutoff and order
+    """
+    rate = 1 / np.median(np.diff(time))
+    sos = butter(order, cutoff, btype='lowpass', output='sos', fs=rate)
+    baseline = sosfiltfilt(sos, values)
+    return baseline, {'cutoff': cutoff, 'order': order}
+
+
+def als_baseline(time, values, lam=1e9, p=0.01, iterations=10):
+    """Baseline by asymmetric least squares (Eilers and Boelens)
+
+        Minimizes sum(w * (y - z)^2) + lam * sum(diff(z, 2)^2), where
+        samples above the baseline get weight p and samples below it
+        1 - p. The system is pentadiagonal and solved with a banded
+        Cholesky factorization, so each iteration is linear in the
+        number of samples
+
+        Parameters
+        ----------
+        time: numpy array
+                time of each sample
+        values: numpy array
+                trace to detrend
+        lam: float
+                smoothness, larger values give a stiffer baseline
+        p: float
+                weight of the samples above the baseline
+        iterations: integer
+                number of reweighting steps
+
+        Returns:
+        --------
+        baseline: numpy array
+        params: dictionary
+                lam, p and iterations
+    """
+    n = len(values)
+    params = {'lam': lam, 'p': p, 'iterations': iterations}
+    if n < 3:
+        return np.array(values, dtype=np.float64), params
+    # Upper bands of lam * D'D for the second difference matrix D
+    bands = np.zeros((3, n))
+    bands[0, 2:] = lam
+    bands[1, 1:] = -4 * lam
+    bands[1, 1] = bands[1, -1] = -2 * lam
+    bands[2, :] = 6 * lam
+    bands[2, [0, -1]] = lam
+    bands[2, [1, -2]] = 5 * lam
+    if n == 3:
+        bands[2, 1] = 4 * lam
+    weights = np.ones(n)
+    for i in range(iterations):
+        system = bands.copy()
+        system[2] += weights
+        baseline = solveh_banded(system, weights * values)
+        weights = np.where(values > baseline, p, 1 - p)
+    return baseline, params
+
+
+# Baseline engines for fit_channel, by the name used in config.yml.
+# Each is called as engine(time, values, **options) and returns the
+# baseline and the parameters it used
+DETRENDERS = {'percentile': rolling_percentile_baseline,
+              'minimum': moving_minimum_baseline,
+              'lowpass': lowpass_baseline,
+              'als': als_baseline}
+
+
+def fit_channel(time, values, min_rsquare, fit_points=None, refine=True,
+                cache_dir=None, max_fits=1000,
+                detrend_method='biexponential', detrend_options=None):
+    """Fits the baseline that normalize divides a channel by
+
+        Parameters
+        ----------
+        time: numpy array
+                time of each sample
+        values: numpy array
+                channel to fit
+        min_rsquare: float
+                fits with a lower r^2 have found no exponential decay
+                and are replaced by the median of the channel
+        fit_points: integer or None
+                if given, the fit uses this many block averages
+                first, see fit_biexponential_coarse
+        refine: boolean
+                if True, coarse fits are refined on every sample
+        cache_dir: string or None
+                if given, fits are cached in this directory and reused
+                while the time, values and options are unchanged
+        max_fits: integer
+                number of fits kept in the cache
+        detrend_method: string
+                'biexponential' to fit fit_exp, or the name of a
+                baseline engine in DETRENDERS: 'percentile',
+                'minimum', 'lowpass' or 'als'. Only the biexponential
+                uses fit_points, refine, the cache and min_rsquare
+        detrend_options: dictionary or None
+                keyword arguments of the baseline engine, e.g.
+                {'window': 120} for 'percentile'
+
+        Returns:
+        --------
+        fit: dictionary
+                'fit', 'parameters', 'rsquare', 'iterations' and
+                'fidelity', see normalize. Iterations is 0 when the
+                fit came from the cache or a baseline engine
+    """
+    time = np.asarray(time, dtype=np.float64)
+    values = np.asarray(values, dtype=np.float64)
+    if detrend_method != 'biexponential':
+        if detrend_method not in DETRENDERS:
+            print("\nError: detrend_method must be biexponential or one "
+                  "of", ', '.join(DETRENDERS))
+            sys.exit(1)
+        fit, params = DETRENDERS[detrend_method](
+            time, values, **(detrend_options or {}))
+        return {'fit': fit,
+                'parameters': params,
+                'rsquare': np.corrcoef(values, fit)[0, 1]**2,
+                'iterations': 0,
+                'fidelity': None}
+
+    cached = None
+    if cache_dir is not None:
+        key = cache_setup.fit_key('biexponential', [time, values],
+                                  {'fit_version': FIT_VERSION,
+                                   'fit_points': fit_points,
+                                   'refine': refine})
+        cached = cache_setup.load_fit(cache_dir, key)
+    if cached is not None:
+        popt = np.array(cached['popt'])
+        iterations = 0
+        fidelity = cached['fidelity']
+    elif fit_points is None:
+        popt, iterations = fit_biexponential(time, values)
+        fidelity = None
+    else:
+        popt, iterations, fidelity = fit_biexponential_coarse(
+            time, values, fit_points, refine)
+    if cache_dir is not None and cached is None:
+        cache_setup.save_fit(cache_dir, key,
+                             {'popt': popt.tolist(), 'fidelity': fidelity},
+                             max_fits)
+    fit = fit_exp(time, *popt)
+    rsquare = np.corrcoef(values, fit)[0, 1]**2
+    if rsquare < min_rsquare:
+        popt = [0, 0, 0, 0, np.median(values)]
+        fit = fit_exp(time, *popt)
+    return {'fit': fit,
+            'parameters': dict(zip('ABCDE', popt)),
+            'rsquare': rsquare,
+            'iterations': iterations,
+            'fidelity': fidelity}
+
+
+def normalize(time, signal, reference, fit_points=None, refine=True,
+              fits=None, cache_dir=None, max_fits=1000, robust=False,
+              detrend_method='biexponential', detrend_options=None):
+    """Normalizes a signal to a reference channel, without plotting
+
+        A biexponential or another baseline (see fit_channel) is
+        fitted to each channel to remove photobleaching. The reference
+        is then scaled to the signal with a linear fit and the signal
+        is divided by it
+
+        Parameters
+        ----------
+        time: numpy array
+                time of each sample, e.g. fTimeGreen
+        signal: numpy array
+                channel to normalize, e.g. f1GreenGreen
+        reference: numpy array
+                motion reference for the signal, e.g. f1GreenIso
+        fit_points: integer or None
+                if given, the biexponentials are fitted to this many
+                block averages first, see fit_biexponential_coarse
+        refine: boolean
+                if True, coarse fits are refined on every sample
+        fits: tuple or None
+                results of fit_channel for the signal and the
+                reference, None to fit them here
+        cache_dir: string or None
+                if given, fits are cached in this directory, see
+                fit_channel
+        max_fits: integer
+                number of fits kept in the cache
+        robust: boolean
+                if True, the reference is scaled with a robust fit that
+                down-weights motion artifacts, see fit_linear
+        detrend_method: string
+                'biexponential' or a baseline engine, see fit_channel
+        detrend_options: dictionary or None
+                keyword arguments of the baseline engine
+
+        Returns:
+        --------
+        result: dictionary
+                'signal fit', 'reference fit': fitted biexponentials
+                'signal parameters', 'reference parameters':
+                        A, B, C, D and E of each biexponential, or
+                        the options of the baseline engine
+                'signal rsquare', 'reference rsquare': r^2 of each fit,
+                        a fit with a very low r^2 (no exponential decay)
+                        is replaced by the median of the channel
+                'signal iterations', 'reference iterations': number
+                        of function evaluations of each fit
+                'signal fidelity', 'reference fidelity': agreement
+                        of the coarse and refined fits, None unless
+                        fit_points and refine are given
+                'signal normed', 'reference normed': channels divided
+                        by their fit
+                'reference scaled': normed reference scaled to the
+                        normed signal
+                'linfit parameters': A and B of that scaling
+                'normalized': final normalized signal
+    """
+    time = np.asarray(time, dtype=np.float64)
+    signal = np.asarray(signal, dtype=np.float64)
+    reference = np.asarray(reference, dtype=np.float64)
+    if fits is None:
+        fits = (fit_channel(time, signal, .01, fit_points, refine,
+                            cache_dir, max_fits, detrend_method,
+                            detrend_options),
+                fit_channel(time, reference, .001, fit_points, refine,
+                            cache_dir, max_fits, detrend_method,
+                            detrend_options))
+    result = {}
+    for name, fit in zip(['signal', 'reference'], fits):
+        for key, value in fit.items():
+            result[name + ' ' + key] = value
+
+    normedSig = signal / result['signal fit']
+    normedRef = reference / result['reference fit']
+
+    popt = None
+    if cache_dir is not None:
+        key = cache_setup.fit_key('linear', [normedSig, normedRef],
+                                  {'fit_version': FIT_VERSION,
+                                   'robust': robust})
+        popt = cache_setup.load_fit(cache_dir, key)
+    if popt is None:
+        popt = fit_linear(normedSig, normedRef, robust)
+        if cache_dir is not None:
+            cache_setup.save_fit(cache_dir, key, list(popt), max_fits)
+
+    AL = popt[0]
+    BL = popt[1]
+
+    AdjustedRef = AL * normedRef
+    AdjustedRef += BL
+    normedToReference = normedSig / AdjustedRef
+
+    result['signal normed'] = normedSig
+    result['reference normed'] = normedRef
+    result['reference scaled'] = AdjustedRef
+    result['linfit parameters'] = {'A': AL, 'B': BL}
+    result['normalized'] = normedToReference
+    return result
+
+
+def normalize_channels(fdata, signals, references, fit_points=None,
+                       refine=True, workers=1, cache_dir=None,
+                       max_fits=1000, robust=False,
+                       detrend_method='biexponential',
+                       detrend_options=None):
+    """Normalizes each signal to its reference and stores the results
+
+        Parameters
+        ----------
+        fdata: pandas dataframe
+                session with fTimeGreen and the channels
+        signals: list
+                channels to normalize, e.g. ['f1GreenGreen']
+        references: list
+                reference of each signal, e.g. ['f1GreenIso']
+        fit_points: integer or None
+                number of block averages for coarse fits, see normalize
+        refine: boolean
+                if True, coarse fits are refined on every sample
+        workers: integer
+                number of processes fitting channels at the same time.
+                Every channel is fitted once, even if it is the
+                reference of several signals, and the results do not
+                depend on the number of workers
+        cache_dir: string or None
+                if given, fits are cached in this directory and reused
+                while the channel data and options are unchanged
+        max_fits: integer
+                number of fits kept in the cache
+        robust: boolean
+                if True, references are scaled with a robust fit
+        detrend_method: string
+                'biexponential' or a baseline engine, see fit_channel
+        detrend_options: dictionary or None
+                keyword arguments of the baseline engine
+
+        Returns:
+        --------
+        fdata: pandas dataframe
+                with the fits, normed channels and final normalized
+                signals added as columns, e.g. 'f1GreenGreen expfit'
+                and 'f1GreenGreen final normalized'
+    """
+    time = fdata['fTimeGreen'].to_numpy(dtype=np.float64)
+    # Signals and references use different r^2 limits
+    jobs = list(dict.fromkeys([(signal, .01) for signal in signals]
+                              + [(reference, .001)
+                                 for reference in references]))
+    args = [(time, fdata[name].to_numpy(dtype=np.float64), min_rsquare,
+             fit_points, refine, cache_dir, max_fits, detrend_method,
+             detrend_options) for name, min_rsquare in jobs]
+    if workers > 1 and len(jobs) > 1:
+        with ProcessPoolExecutor(max_workers=min(workers, len(jobs))) as pool:
+            # Futures are read in submission order, so the merge is
+            # the same whichever fit finishes first
+            futures = [pool.submit(fit_channel, *job) for job in args]
+            fits = dict(zip(jobs, [future.result() for future in futures]))
+    else:
+        fits = dict(zip(jobs, [fit_channel(*job) for job in args]))
+
+    columns = {}
+    for i in range(len(signals)):
+        result = normalize(time, fdata[signals[i]], fdata[references[i]],
+                           fits=(fits[(signals[i], .01)],
+                                 fits[(references[i], .001)]),
+                           cache_dir=cache_dir, max_fits=max_fits,
+                           robust=robust)
+        sigRsquare = result['signal rsquare']
+        refRsquare = result['reference rsquare']
         print('sig r^2 =', sigRsquare ,'ref r^2 =', refRsquare )
-        
-        if sigRsquare < .01:
+        print('fit iterations: sig', result['signal iterations'],
+              'ref', result['reference iterations'])
+        if result['signal fidelity'] is not None:
+            print('coarse fit difference / noise: sig',
+                  result['signal fidelity'], 'ref',
+                  result['reference fidelity'])
+        # Only the biexponential falls back to the median, the other
+        # engines always return their baseline
+        if detrend_method == 'biexponential' and sigRsquare < .01:
             print('sig r^2 =', sigRsquare)
             print('No exponential decay was detected in ', signals[i])
             print(signals[i] + ' expfit is now the median of ', signals[i])
-            AS=0
-            BS=0
-            CS=0
-            DS=0
-            ES=np.median(fdata[signals[i]])
-            fitSig = fit_exp(fdata['fTimeGreen'], AS, BS, CS, DS, ES)
-            
-        
-        if refRsquare < .001:
+        if detrend_method == 'biexponential' and refRsquare < .001:
             print('ref r^2 =', refRsquare)
             print('No exponential decay was detected in ', references[i])
             print(references[i] + ' expfit is now the median  ', references[i])
-            AR=0
-            BR=0
-            CR=0
-            DR=0
-            ER= np.median(fdata[references[i]])
-            fitRef = fit_exp(fdata['fTimeGreen'], AR, BR, CR, DR, ER)
-            
-            
-        normedSig=[(k/j) for k,j in zip(fdata[signals[i]], fitSig)]
-        normedRef=[(k/j) for k,j in zip(fdata[references[i]], fitRef)]      
-        
-        popt, pcov = curve_fit(lin_fit, normedSig, normedRef, bounds=([0, -5],[np.inf, 5]))
-        
-        AL =popt[0]
-        BL =popt[1]
-        
-        AdjustedRef=[AL* j + BL for j in normedRef]
-        normedToReference=[(k/j) for k,j in zip(normedSig, AdjustedRef)]
-        
-        fdata.loc[:,signals[i] + ' expfit']=fitSig
-        fdata.loc[:,signals[i] + ' expfit parameters']=['na']
-        fdata.at[0:4, signals[i] + ' expfit parameters']=['A= ' + str(AS), 'B= ' + str(BS), 'C= ' + str(CS), 'D= ' + str(DS), 'E= ' + str(ES)]
-        fdata.loc[:,signals[i] + ' normed to exp']=normedSig
-        fdata.loc[:,references[i] + ' expfit']=fitRef
-        fdata.loc[:,references[i] + ' expfit parameters']=['na']
-        fdata.at[0:4,references[i] + ' expfit parameters']=['A= ' + str(AR), 'B= ' + str(BR), 'C= ' + str(CR), 'D= ' + str(DR), 'E= ' + str(ER)]
-        fdata.loc[:,references[i] + ' normed to exp']=normedRef
-        fdata.loc[:,references[i] + ' fitted to ' + signals[i]]=AdjustedRef
-        fdata.loc[:,references[i] + ' linfit parameters']=['na']
-        fdata.at[0:1,references[i] + ' linfit parameters']= ['A= ' + str(AL), 'B= ' + str(BL)]
-        fdata.loc[:,signals[i] + ' final normalized'] = normedToReference
-        
+
+        columns[signals[i] + ' expfit'] = result['signal fit']
+        store_fit_parameters(fdata, signals[i] + ' expfit parameters',
+                             result['signal parameters'], columns)
+        columns[signals[i] + ' normed to exp'] = result['signal normed']
+        columns[references[i] + ' expfit'] = result['reference fit']
+        store_fit_parameters(fdata, references[i] + ' expfit parameters',
+                             result['reference parameters'], columns)
+        columns[references[i] + ' normed to exp'] = result['reference normed']
+        columns[references[i] + ' fitted to ' + signals[i]] = (
+            result['reference scaled'])
+        store_fit_parameters(fdata, references[i] + ' linfit parameters',
+                             result['linfit parameters'], columns)
+        columns[signals[i] + ' final normalized'] = result['normalized']
+
+    return add_columns(fdata, columns)
+
+
+def add_columns(fdata, columns):
+    """Adds many columns to a session in one step
+
+        Parameters
+        ----------
+        fdata: pandas dataframe
+                session to add the columns to
+        columns: dictionary
+                arrays by column name. Columns that are already in
+                fdata are replaced
+
+        Returns:
+        --------
+        fdata: pandas dataframe
+                new dataframe with the same attrs
+    """
+    attrs = fdata.attrs
+    new = pd.DataFrame(columns, index=fdata.index)
+    fdata = pd.concat([fdata.drop(columns=new.columns.intersection(
+        fdata.columns)), new], axis=1)
+    fdata.attrs = attrs
+    return fdata
+
+
+def filter_channels(fdata, lowpass=None, highpass=None, order=4,
+                    decimate=1, columns=None):
+    """Filters the signals of a session without phase shift and
+        decimates it by an integer factor
+
+        The signals are filtered with a Butterworth filter in second
+        order sections, run forwards and backwards (sosfiltfilt).
+        Before decimating, the low-pass is lowered to 0.8 times the
+        new Nyquist frequency if needed, and every other float column
+        except the fTime columns is low-passed at that frequency, so
+        no column is aliased
+
+        Parameters
+        ----------
+        fdata: pandas dataframe
+                session with fTimeGreen
+        lowpass: float or None
+                low-pass cutoff in Hz
+        highpass: float or None
+                high-pass cutoff in Hz, with lowpass a band-pass
+        order: integer
+                order of the filter
+        decimate: integer
+                keep every decimate-th sample. Behavior columns are
+                True in a kept sample if they are True anywhere in
+                its block, and other text columns keep their first
+                rows, which hold e.g. fit parameters. Behavior
+                intervals in fdata.attrs['behaviors'] and the samples
+                of fdata.attrs['frame drops'] are rescaled the same way
+        columns: list or None
+                columns filtered with lowpass and highpass, None for
+                every final normalized signal
+
+        Returns:
+        --------
+        fdata: pandas dataframe
+                filtered and decimated copy, the settings are stored
+                in fdata.attrs['filter']
+    """
+    if 'filter' in fdata.attrs:
+        print('The data was already filtered with', fdata.attrs['filter'])
+        return fdata
+    decimate = int(decimate)
+    if decimate < 1:
+        print("\nError: decimate must be a positive integer")
+        sys.exit(1)
+    if columns is None:
+        columns = [name for name in fdata.columns
+                   if name.endswith(' final normalized')]
+    missing = [name for name in columns if name not in fdata.columns]
+    if len(missing) > 0:
+        print("\nError: cannot filter", ', '.join(missing),
+              "as the columns are not in the data")
+        sys.exit(1)
+
+    rate = 1 / np.median(np.diff(fdata['fTimeGreen'].to_numpy()))
+    cutoff = lowpass
+    anti_alias = None
+    if decimate > 1:
+        anti_alias = 0.8 * rate / (2 * decimate)
+        cutoff = anti_alias if cutoff is None else min(cutoff, anti_alias)
+    for name, value in (('low-pass', cutoff), ('high-pass', highpass)):
+        if value is not None and not 0 < value < rate / 2:
+            print("\nError: the " + name + " cutoff must be between 0 and",
+                  rate / 2, "Hz, half the sampling rate")
+            sys.exit(1)
+    if cutoff is not None and highpass is not None and highpass >= cutoff:
+        print("\nError: the high-pass cutoff must be below the low-pass "
+              "cutoff, which is", cutoff, "Hz after decimating by",
+              decimate)
+        sys.exit(1)
+
+    sos = None
+    if cutoff is not None and highpass is not None:
+        sos = butter(order, [highpass, cutoff], btype='bandpass',
+                     output='sos', fs=rate)
+    elif cutoff is not None:
+        sos = butter(order, cutoff, btype='lowpass', output='sos', fs=rate)
+    elif highpass is not None:
+        sos = butter(order, highpass, btype='highpass', output='sos',
+                     fs=rate)
+    alias_sos = None
+    if anti_alias is not None:
+        alias_sos = butter(order, anti_alias, btype='lowpass',
+                           output='sos', fs=rate)
+
+    n = len(fdata) // decimate
+    filtered = {}
+    for name in fdata.columns:
+        values = fdata[name].to_numpy()
+        if name in columns:
+            column_sos = sos
+        elif (np.issubdtype(values.dtype, np.floating)
+                and not name.startswith('fTime')):
+            column_sos = alias_sos
+        else:
+            column_sos = None
+        if column_sos is not None:
+            values = sosfiltfilt(column_sos, values.astype(
+                np.float64)).astype(values.dtype)
+        if decimate == 1:
+            filtered[name] = values
+        elif values.dtype == bool:
+            filtered[name] = values[:n * decimate].reshape(
+                n, decimate).any(axis=1)
+        elif np.issubdtype(values.dtype, np.number):
+            filtered[name] = values[:n * decimate:decimate]
+        else:
+            filtered[name] = values[:n]
+
+    attrs = copy.deepcopy(fdata.attrs)
+    if decimate > 1 and 'behaviors' in attrs:
+        # A kept sample is in a behavior interval if any sample of its
+        # block is
+        attrs['behaviors'] = {
+            beh: dict(events,
+                      start=[min(start // decimate, n)
+                             for start in events['start']],
+                      stop=[min(-(-stop // decimate), n)
+                            for stop in events['stop']])
+            for beh, events in attrs['behaviors'].items()}
+    if decimate > 1 and 'sample' in attrs.get('frame drops', {}):
+        attrs['frame drops']['sample'] = [
+            min(sample // decimate, n)
+            for sample in attrs['frame drops']['sample']]
+    fdata = pd.DataFrame(filtered)
+    fdata.attrs = attrs
+    fdata.attrs['filter'] = {'lowpass': lowpass, 'highpass': highpass,
+                             'order': order, 'decimate': decimate,
+                             'cutoff': cutoff, 'columns': list(columns),
+                             'anti-alias cutoff': anti_alias,
+                             'sampling rate': rate / decimate}
+    return fdata
+
+
+def delta_f(values, baseline):
+    """Returns dF/F, the change of a trace relative to its baseline"""
+    values = np.asarray(values, dtype=np.float64)
+    return (values - baseline) / baseline
+
+
+def zscore(values):
+    """Returns the z-score of a trace over the whole session"""
+    values = np.asarray(values, dtype=np.float64)
+    return (values - values.mean()) / values.std()
+
+
+def rolling_zscore(time, values, window):
+    """Returns the z-score of each sample within a centered window
+
+        The mean and standard deviation of every window come from
+        cumulative sums, so the cost does not depend on the window
+        length. Windows are shorter at the ends of the trace
+
+        Parameters
+        ----------
+        time: numpy array
+                time of each sample
+        values: numpy array
+                trace to standardize
+        window: float
+                window length in seconds
+
+        Returns:
+        --------
+        zscores: numpy array
+                nan where a window has no variance
+    """
+    values = np.asarray(values, dtype=np.float64)
+    n = len(values)
+    half = sample_window(time, window) // 2
+    # Removing the session mean keeps the sums small and accurate
+    centered = values - values.mean()
+    sums = np.concatenate(([0], np.cumsum(centered)))
+    squares = np.concatenate(([0], np.cumsum(centered * centered)))
+    index = np.arange(n)
+    start = np.maximum(index - half, 0)
+    stop = np.minimum(index + half + 1, n)
+    count = stop - start
+    mean = (sums[stop] - sums[start]) / count
+    variance = np.maximum((squares[stop] - squares[start]) / count
+                          - mean * mean, 0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return (centered - mean) / np.sqrt(variance)
+
+
+def transform_channels(fdata, signals, rolling_window=60):
+    """Adds dF/F, z-score and rolling z-score columns of normalized
+        signals, so later analyses do not compute them again
+
+        Parameters
+        ----------
+        fdata: pandas dataframe
+                session with the final normalized signals, see
+                normalize_channels
+        signals: list
+                normalized channels, e.g. ['f1GreenGreen']
+        rolling_window: float
+                window of the rolling z-score in seconds, stored in
+                fdata.attrs['rolling zscore window']
+
+        Returns:
+        --------
+        fdata: pandas dataframe
+                with e.g. 'f1GreenGreen dF/F', 'f1GreenGreen zscore'
+                and 'f1GreenGreen rolling zscore' added
+    """
+    time = fdata['fTimeGreen'].to_numpy()
+    columns = {}
+    for signal in signals:
+        if signal + ' final normalized' not in fdata.columns:
+            print('\nError:', signal, 'must be normalized before dF/F '
+                  'and z-scores are computed')
+            sys.exit(1)
+        # The normalized signal is F/F0
+        normalized = fdata[signal + ' final normalized'].to_numpy(
+            dtype=np.float64)
+        columns[signal + ' dF/F'] = delta_f(normalized, 1.0)
+        columns[signal + ' zscore'] = zscore(normalized)
+        columns[signal + ' rolling zscore'] = rolling_zscore(
+            time, normalized, rolling_window)
+    fdata = add_columns(fdata, columns)
+    fdata.attrs['rolling zscore window'] = rolling_window
+    return fdata
+
+
+def plot_fitted_exp(fdata, file, signals, references, fit_points=None,
+                    refine=True, workers=1, cache_dir=None, max_fits=1000,
+                    robust=False, detrend_method='biexponential',
+                    detrend_options=None):
+    import plotly.express as px
+    import plotly.graph_objects as go
+    from plotly.subplots import make_subplots
+    """Normalizes data with normalize_channels and plots each step
+        of the normalization of every signal
+
+        Parameters
+        ----------
+        fdata: pandas dataframe
+                session with fTimeGreen and the channels
+        file: string
+                name of the session, used in the plot titles
+        signals: list
+                channels to normalize, e.g. ['f1GreenGreen']
+        references: list
+                reference of each signal, e.g. ['f1GreenIso']
+        fit_points: integer or None
+                number of block averages for coarse fits, see normalize
+        refine: boolean
+                if True, coarse fits are refined on every sample
+        workers: integer
+                number of processes fitting channels at the same time
+        cache_dir: string or None
+                if given, fits are cached in this directory
+        max_fits: integer
+                number of fits kept in the cache
+        robust: boolean
+                if True, references are scaled with a robust fit
+        detrend_method: string
+                'biexponential' or a baseline engine, see fit_channel
+        detrend_options: dictionary or None
+                keyword arguments of the baseline engine
+        Returns:
+        --------
+        fdata: pandas dataframe
+                with the normalization columns added
+    """
+    fdata = normalize_channels(fdata, signals, references, fit_points,
+                               refine, workers, cache_dir, max_fits, robust,
+                               detrend_method, detrend_options)
+    for i in range(len(signals)):
         fig = make_subplots(rows=3, cols=2, x_title='Time(s)', subplot_titles=("Biexponential Fitted to Signal", "Signal Normalized to Biexponential", "Biexponential Fitted to Ref", "Reference Normalized to Biexponential", "Reference Linearly Fitted to Signal", "Final Normalized Signal"), shared_xaxes=True, vertical_spacing=0.1)
         fig.add_trace(
             go.Scatter(
@@ -512,20 +1824,288 @@ def plot_fitted_exp(fdata, file, signals, references):
 
 def fit_exp(values, a, b, c, d, e):
     """Transforms data into an exponential function
-        of the form y=A*exp(-B*X)+C*exp(-D*x)
+        of the form y=A*exp(-B*X)+C*exp(-D*x)+E
 
         Parameters
         ----------
         values: list
                 data
-        a, b, c, d: integers or floats
+        a, b, c, d, e: integers or floats
                 estimates for the parameter values of
-                A, B, C and D
+                A, B, C, D and E
     """
-    values = np.array(values)
+    values = np.asarray(values)
 
     return a * np.exp(-b * values) + c * np.exp(-d * values) + e
 
+
+def fit_exp_jacobian(values, a, b, c, d, e):
+    """Returns the derivatives of fit_exp by A, B, C, D and E
+
+        Parameters
+        ----------
+        values: numpy array
+                data
+        a, b, c, d, e: floats
+                parameter values of A, B, C, D and E
+
+        Returns:
+        --------
+        jacobian: numpy array
+                one row per value, one column per parameter
+    """
+    values = np.asarray(values)
+    fast = np.exp(-b * values)
+    slow = np.exp(-d * values)
+    jacobian = np.empty((len(values), 5))
+    jacobian[:, 0] = fast
+    jacobian[:, 1] = -a * values * fast
+    jacobian[:, 2] = slow
+    jacobian[:, 3] = -c * values * slow
+    jacobian[:, 4] = 1
+    return jacobian
+
+
+def biexponential_p0(time, values, n_blocks=200):
+    """Estimates starting parameters of fit_exp from the data
+
+        The trace is block averaged and E is set just below its
+        minimum. The slow decay (C, D) is a log-linear fit to the
+        second half of the trace and the fast decay (A, B) is a
+        log-linear fit to what is left of the first fifth
+
+        Parameters
+        ----------
+        time: numpy array
+                time of each sample
+        values: numpy array
+                trace to fit
+        n_blocks: integer
+                number of block averages the estimate is made from
+
+        Returns:
+        --------
+        p0: tuple
+                non-negative starting values for A, B, C, D and E
+    """
+    t, y = block_average(time, values, n_blocks)
+    span = y.max() - y.min() if len(y) > 0 else 0
+    if len(y) < 10 or span == 0:
+        return (0, 0, 0, 0, max(float(np.mean(values)), 0))
+
+    e = max(y.min() - 0.05 * span, 0)
+    z = np.maximum(y - e, 1e-3 * span)
+    tail = slice(len(y) // 2, None)
+    slope, intercept = np.polyfit(t[tail], np.log(z[tail]), 1)
+    d = max(-slope, 0)
+    c = np.exp(intercept)
+
+    head = slice(0, len(y) // 5)
+    rest = z[head] - c * np.exp(-d * t[head])
+    positive = rest > 0
+    if positive.sum() >= 2:
+        slope, intercept = np.polyfit(t[head][positive],
+                                      np.log(rest[positive]), 1)
+        a = np.exp(intercept)
+        b = max(-slope, d)
+    else:
+        a = 0
+        b = d
+    return (a, b, c, d, e)
+
+
+def block_average(time, values, n_blocks):
+    """Averages a trace over blocks of neighbouring samples
+
+        Parameters
+        ----------
+        time: numpy array
+                time of each sample
+        values: numpy array
+                trace to average
+        n_blocks: integer
+                number of blocks, at most one per sample
+
+        Returns:
+        --------
+        time, values: numpy arrays
+                mean time and value of each block. The last block
+                holds the samples left over and may be shorter
+    """
+    time = np.asarray(time, dtype=np.float64)
+    values = np.asarray(values, dtype=np.float64)
+    size = max(1, len(values) // max(n_blocks, 1))
+    n = len(values) // size * size
+    t = time[:n].reshape(-1, size).mean(axis=1)
+    y = values[:n].reshape(-1, size).mean(axis=1)
+    if n < len(values):
+        t = np.append(t, time[n:].mean())
+        y = np.append(y, values[n:].mean())
+    return t, y
+
+
+def fit_biexponential(time, values, p0=None):
+    """Fits fit_exp to a trace by bounded least squares
+
+        Uses the closed-form fit_exp_jacobian and a starting point
+        from biexponential_p0. All parameters must be positive
+
+        Parameters
+        ----------
+        time: numpy array
+                time of each sample
+        values: numpy array
+                trace to fit
+        p0: sequence or None
+                starting A, B, C, D and E, None to estimate them
+
+        Returns:
+        --------
+        popt: numpy array
+                fitted A, B, C, D and E
+        iterations: integer
+                number of function evaluations
+    """
+    time = np.asarray(time, dtype=np.float64)
+    values = np.asarray(values, dtype=np.float64)
+    fit = least_squares(lambda p: fit_exp(time, *p) - values,
+                        p0 if p0 is not None else biexponential_p0(
+                            time, values),
+                        jac=lambda p: fit_exp_jacobian(time, *p),
+                        bounds=(0, np.inf), x_scale='jac')
+    return fit.x, fit.nfev
+
+
+def fit_biexponential_coarse(time, values, n_points, refine=True):
+    """Fits fit_exp to a block averaged copy of a trace first
+
+        Photobleaching is slow, so a few thousand block averages
+        describe it fully and fit much faster than every sample
+
+        Parameters
+        ----------
+        time: numpy array
+                time of each sample
+        values: numpy array
+                trace to fit
+        n_points: integer
+                number of block averages the coarse fit uses
+        refine: boolean
+                if True, the fit is repeated on every sample starting
+                from the coarse parameters
+
+        Returns:
+        --------
+        popt: numpy array
+                fitted A, B, C, D and E
+        iterations: integer
+                number of function evaluations of both fits
+        fidelity: float or None
+                RMS difference between the coarse and the refined fit
+                curves divided by the RMS residual of the refined fit,
+                None without refine. Values well below 1 mean the
+                coarse fit is as good as the full resolution fit
+    """
+    time = np.asarray(time, dtype=np.float64)
+    values = np.asarray(values, dtype=np.float64)
+    coarse_time, coarse_values = block_average(time, values, n_points)
+    popt, iterations = fit_biexponential(coarse_time, coarse_values)
+    if not refine:
+        return popt, iterations, None
+
+    fine, fine_iterations = fit_biexponential(time, values, p0=popt)
+    fine_fit = fit_exp(time, *fine)
+    noise = np.sqrt(np.mean((values - fine_fit) ** 2))
+    difference = np.sqrt(np.mean((fit_exp(time, *popt) - fine_fit) ** 2))
+    fidelity = difference / noise if noise > 0 else 0.0
+    return fine, iterations + fine_iterations, fidelity
+
+
+def fit_linear(x, y, robust=False, a_min=0, b_bounds=(-5, 5),
+               max_iterations=50):
+    """Fits y = A*x + B by least squares with bounds, in closed form
+
+        The bounded problem has its minimum either at the unbounded
+        solution or on an edge of the bounds, so each is solved
+        directly and the best one within the bounds is kept. The
+        robust mode reweights the samples with Huber weights (IRLS),
+        so motion artifacts pull less on the fit
+
+        Parameters
+        ----------
+        x, y: numpy arrays
+                data
+        robust: boolean
+                if True, large residuals are down-weighted
+        a_min: float
+                lower bound of A
+        b_bounds: tuple
+                lower and upper bound of B
+        max_iterations: integer
+                most reweighting steps of the robust mode
+
+        Returns:
+        --------
+        a, b: floats
+                fitted A and B
+    """
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    a, b = _weighted_linear(x, y, None, a_min, b_bounds)
+    if not robust:
+        return float(a), float(b)
+
+    for i in range(max_iterations):
+        residuals = y - (a * x + b)
+        # Huber weights with the usual 1.345 tuning constant and a
+        # scale from the median absolute deviation
+        scale = 1.4826 * np.median(np.abs(residuals - np.median(residuals)))
+        if scale == 0:
+            break
+        weights = np.minimum(1, 1.345 * scale / np.maximum(
+            np.abs(residuals), 1e-300))
+        new_a, new_b = _weighted_linear(x, y, weights, a_min, b_bounds)
+        done = (abs(new_a - a) <= 1e-10 * max(abs(a), 1)
+                and abs(new_b - b) <= 1e-10 * max(abs(b), 1))
+        a, b = new_a, new_b
+        if done:
+            break
+    return float(a), float(b)
+
+
+def _weighted_linear(x, y, weights, a_min, b_bounds):
+    """Solves the bounded weighted least squares of fit_linear"""
+    if weights is None:
+        sw = len(x)
+        swx, swy = x.sum(), y.sum()
+        swxx, swxy, swyy = x @ x, x @ y, y @ y
+    else:
+        wx = weights * x
+        sw, swx, swy = weights.sum(), wx.sum(), weights @ y
+        swxx, swxy, swyy = wx @ x, wx @ y, (weights * y) @ y
+
+    def cost(a, b):
+        return (swyy - 2 * a * swxy - 2 * b * swy + a * a * swxx
+                + 2 * a * b * swx + b * b * sw)
+
+    b_min, b_max = b_bounds
+    candidates = []
+    det = sw * swxx - swx * swx
+    if det > 0:
+        a = (sw * swxy - swx * swy) / det
+        b = (swy - a * swx) / sw
+        if a >= a_min and b_min <= b <= b_max:
+            return a, b
+    # A on its bound
+    candidates.append((a_min, min(max((swy - a_min * swx) / sw, b_min),
+                                  b_max)))
+    # B on either bound
+    for b in b_bounds:
+        a = (swxy - b * swx) / swxx if swxx > 0 else a_min
+        candidates.append((max(a, a_min), b))
+    return min(candidates, key=lambda ab: cost(*ab))
+
+
 def lin_fit(values, a, b):
 
     values = np.array(values)
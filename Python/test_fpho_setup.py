@@ -4,14 +4,62 @@ TO DO: Needs documentation and comments
 
 """
 import fpho_setup
+import cache_setup
+import behavior_setup
 import unittest
 import random
 import sys
+import tempfile
+import numpy as np
+from scipy.optimize import curve_fit
+from scipy import stats
 import pandas as pd
 import os.path
 from os import path
 
 
+def write_bonsai_file(dirname, n_frames=1200, seed=0):
+    """Writes a small synthetic Bonsai file cycling iso, green, red"""
+    rng = np.random.default_rng(seed)
+    flags = np.resize([17, 18, 20], n_frames)
+    df = pd.DataFrame({'FrameCounter': np.arange(n_frames),
+                       'Timestamp': 1000 + 0.025 * np.arange(n_frames),
+                       'Flags': flags,
+                       'Region0R': rng.normal(500, 5, n_frames),
+                       'Region1R': rng.normal(600, 5, n_frames),
+                       'Region2G': flags * 100 + rng.normal(0, 5, n_frames),
+                       'Region3G': flags * 50 + rng.normal(0, 5, n_frames)})
+    filename = os.path.join(dirname, 'bonsai.csv')
+    df.to_csv(filename, index=False)
+    return filename, df
+
+
+def import_bonsai_file(filename, frameshift=False, framedrops=0, **kwargs):
+    """Imports a synthetic Bonsai file as two fiber data"""
+    return fpho_setup.import_fpho_data(input_filename=filename,
+                                       output_filename='my_file_name',
+                                       f1greencol=5, f1redcol=3,
+                                       f2greencol=6, f2redcol=4,
+                                       animal_ID='vole1',
+                                       exp_date='2020-09-01',
+                                       exp_desc='testing',
+                                       frameshift=frameshift,
+                                       framedrops=framedrops, **kwargs)
+
+
+def write_boris_file(dirname, events):
+    """Writes a small BORIS tabular export of (time, behavior, status)"""
+    filename = os.path.join(dirname, 'boris.csv')
+    with open(filename, 'w') as f:
+        f.write('Observation id,test\n' + ',\n' * 14)
+        f.write('Time,Media file path,Total length,FPS,Subject,Behavior,'
+                'Behavioral category,Comment,Status\n')
+        for time, behavior, status in events:
+            f.write('%.3f,video.mp4,100,30,vole1,%s,,,%s\n'
+                    % (time, behavior, status))
+    return filename
+
+
 class TestFphoSetup(unittest.TestCase):
 
     def test_import_fpho_data(self):
@@ -46,6 +94,685 @@ class TestFphoSetup(unittest.TestCase):
                                         write_xlsx=False)
         self.assertEqual(cm.exception.code, 1)
 
+    def test_demux_frames(self):
+        flags = np.resize([17, 18, 20], 20)
+        green, red, iso = fpho_setup.demux_frames(flags, start_idx=0)
+        self.assertEqual(list(green), [1, 4, 7, 10, 13, 16])
+        self.assertEqual(list(red), [2, 5, 8, 11, 14, 17])
+        self.assertEqual(list(iso), [3, 6, 9, 12, 15, 18])
+
+    def test_import_fpho_data_demux(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            filename, raw = write_bonsai_file(tmp)
+            df = import_bonsai_file(filename)
+        # First green frame after the 301 discarded frames is row 301
+        self.assertEqual(len(df), (1199 - 301) // 3)
+        self.assertEqual(df['f1GreenGreen'].dtype, np.float64)
+        self.assertAlmostEqual(df['f1GreenGreen'][0], raw['Region2G'][301])
+        self.assertAlmostEqual(df['f1GreenRed'][0], raw['Region2G'][302])
+        self.assertAlmostEqual(df['f1GreenIso'][0], raw['Region2G'][303])
+        self.assertAlmostEqual(df['f1RedGreen'][0], raw['Region0R'][301])
+        self.assertAlmostEqual(df['f2RedIso'][0], raw['Region1R'][303])
+        self.assertAlmostEqual(df['fTimeGreen'][0], 0.025 * 301)
+        self.assertEqual(df['animalID'][0], 'vole1')
+
+    def test_import_fpho_data_fiber2_columns(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            filename, raw = write_bonsai_file(tmp)
+            kwargs = dict(input_filename=filename,
+                          output_filename='my_file_name',
+                          f1greencol=5, f1redcol=3, f2greencol='6',
+                          animal_ID='vole1', exp_date='2020-09-01',
+                          exp_desc='testing')
+            df = fpho_setup.import_fpho_data(f2redcol='4', **kwargs)
+            self.assertAlmostEqual(df['f2RedIso'][0], raw['Region1R'][303])
+            for f2redcol in [None, 'None', 'four', 6]:
+                with self.assertRaises(SystemExit):
+                    fpho_setup.import_fpho_data(f2redcol=f2redcol, **kwargs)
+
+    def test_import_fpho_data_chunked(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            filename, raw = write_bonsai_file(tmp)
+            # Drop a frame so the cycles are out of step across chunks
+            raw.drop(index=700).to_csv(filename, index=False)
+            df = import_bonsai_file(filename)
+            for chunksize in [1, 7, 300, 5000]:
+                chunked = import_bonsai_file(filename, chunksize=chunksize)
+                pd.testing.assert_frame_equal(df, chunked)
+            # Only a green and a red frame after the discarded frames
+            filename, raw = write_bonsai_file(tmp, n_frames=304)
+            with self.assertRaises(SystemExit):
+                import_bonsai_file(filename, frameshift=False, chunksize=7)
+
+    def test_import_fpho_data_cache(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            filename, raw = write_bonsai_file(tmp)
+            cache_dir = os.path.join(tmp, 'cache')
+            df = import_bonsai_file(filename, cache_dir=cache_dir)
+            self.assertEqual(len(os.listdir(cache_dir)), 1)
+            first_key = os.listdir(cache_dir)[0]
+            cached = import_bonsai_file(filename, cache_dir=cache_dir)
+            pd.testing.assert_frame_equal(df, cached)
+
+            # Changing the file content gives a new cache entry
+            raw.iloc[:-3].to_csv(filename, index=False)
+            import_bonsai_file(filename, cache_dir=cache_dir)
+            self.assertEqual(len(os.listdir(cache_dir)), 2)
+
+            # A new import version parses the file again
+            version = fpho_setup.IMPORT_VERSION
+            try:
+                fpho_setup.IMPORT_VERSION = version + 1
+                import_bonsai_file(filename, cache_dir=cache_dir)
+            finally:
+                fpho_setup.IMPORT_VERSION = version
+            self.assertEqual(len(os.listdir(cache_dir)), 3)
+
+            # Loading the first session again keeps it when the least
+            # recently used sessions are removed
+            raw.to_csv(filename, index=False)
+            import_bonsai_file(filename, cache_dir=cache_dir)
+            raw.iloc[:-6].to_csv(filename, index=False)
+            import_bonsai_file(filename, cache_dir=cache_dir,
+                               max_sessions=2)
+            names = os.listdir(cache_dir)
+            self.assertEqual(len(names), 2)
+            self.assertIn(first_key, names)
+
+    def test_read_summary_cache(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            summary = os.path.join(tmp, 'test_Summary.csv')
+            df = pd.DataFrame({'animalID': 'vole1',
+                               'fTimeGreen': [0.0, 0.1, 0.2],
+                               'f1GreenGreen expfit parameters':
+                                   ['A= 1', 'B= 2', 'na'],
+                               'Huddle': [True, False, True]})
+            df.to_csv(summary, index=False)
+            cache_dir = os.path.join(tmp, 'cache')
+            first = cache_setup.read_summary(summary, cache_dir)
+            second = cache_setup.read_summary(summary, cache_dir)
+            pd.testing.assert_frame_equal(first, second)
+            self.assertEqual(second['animalID'][2], 'vole1')
+
+    def test_summary_columns(self):
+        df = pd.DataFrame({'animalID': 'vole1',
+                           'fTimeGreen': [0.0, 0.1, 0.2],
+                           'f1GreenGreen': [1.0, 2.0, 3.0],
+                           'f1GreenGreen final normalized': [1.0, 1.1, 0.9],
+                           'Huddle': [True, False, True]})
+        with tempfile.TemporaryDirectory() as tmp:
+            for summary_format in ['csv', 'npy']:
+                filename = cache_setup.summary_filename(
+                    os.path.join(tmp, 'test'), summary_format)
+                cache_setup.write_summary(df, filename)
+                full = cache_setup.read_summary(filename)
+                pd.testing.assert_frame_equal(df, full, check_dtype=False)
+                pruned = cache_setup.read_summary(
+                    filename, columns={'fTimeGreen', 'Huddle', 'missing',
+                                       'f1GreenGreen final normalized'})
+                self.assertEqual(list(pruned.columns),
+                                 ['fTimeGreen',
+                                  'f1GreenGreen final normalized', 'Huddle'])
+                self.assertEqual(pruned['Huddle'].dtype, bool)
+
+    def test_import_fpho_data_compact(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            filename, raw = write_bonsai_file(tmp)
+            df = import_bonsai_file(filename)
+            compact = import_bonsai_file(filename, compact=True, float32=True)
+            self.assertNotIn('animalID', compact.columns)
+            self.assertEqual(fpho_setup.session_info(compact, 'animalID'),
+                             'vole1')
+            self.assertEqual(fpho_setup.session_info(df, 'date'),
+                             '2020-09-01')
+            self.assertEqual(compact['f1GreenGreen'].dtype, np.float32)
+            self.assertEqual(compact['fTimeGreen'].dtype, np.float64)
+
+            fpho_setup.store_fit_parameters(compact, 'f1GreenIso linfit '
+                                            'parameters', {'A': 2, 'B': 1})
+            for summary_format in ['csv', 'npy']:
+                summary = cache_setup.summary_filename(
+                    os.path.join(tmp, 'test'), summary_format)
+                cache_setup.write_summary(compact, summary)
+                reloaded = cache_setup.read_summary(summary)
+                self.assertEqual(reloaded.attrs['animalID'], 'vole1')
+                self.assertEqual(
+                    reloaded.attrs['f1GreenIso linfit parameters']['A'], 2)
+
+    def test_store_fit_parameters(self):
+        df = pd.DataFrame({'fTimeGreen': [0.0, 0.1, 0.2, 0.3]})
+        fpho_setup.store_fit_parameters(df, 'linfit parameters',
+                                        {'A': 2.5, 'B': 1})
+        self.assertEqual(list(df['linfit parameters']),
+                         ['A= 2.5', 'B= 1', 'na', 'na'])
+
+    def test_read_bonsai_csv(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            filename, raw = write_bonsai_file(tmp)
+            for engine in ['c', 'pyarrow']:
+                if engine == 'pyarrow':
+                    try:
+                        import pyarrow
+                    except ImportError:
+                        continue
+                file = fpho_setup.read_bonsai_csv(
+                    filename, {'f1Green': 5, 'f1Red': 3}, engine=engine)
+                self.assertEqual(list(file.columns),
+                                 ['Timestamp', 'Flags', 'f1Green', 'f1Red'])
+                self.assertTrue((file.dtypes == np.float64).all())
+                chunks = fpho_setup.read_bonsai_csv(
+                    filename, {'f1Green': 5, 'f1Red': 3}, chunksize=100,
+                    engine=engine)
+                pd.testing.assert_frame_equal(
+                    file, pd.concat(chunks, ignore_index=True))
+
+            with self.assertRaises(SystemExit):
+                fpho_setup.read_bonsai_csv(filename, {'f1Green': 7})
+
+    def test_group_cycles(self):
+        flags = np.array([18, 20, 17, 18, 17, 18, 20, 17, 18, 20, 17, 18])
+        time = np.arange(12) * 0.025
+        # A whole cycle is missing between frames 7 and 8
+        time[8:] += 0.075
+        green, red, iso, drops, lengths = fpho_setup.group_cycles(flags,
+                                                                  time)
+        self.assertEqual(list(green), [0, 5, 8])
+        self.assertEqual(list(red), [1, 6, 9])
+        self.assertEqual(list(iso), [2, 7, 10])
+        self.assertEqual(list(drops), [3])
+
+        # Frame 9 follows a gap, so cycle 8 is broken as well
+        time[9:] += 0.1
+        green, red, iso, drops, lengths = fpho_setup.group_cycles(
+            flags, time, frame_interval=0.025)
+        self.assertEqual(list(green), [0, 5])
+        self.assertEqual(list(drops), [3, 8, 9])
+
+    def test_import_fpho_data_irregular_start(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            filename, raw = write_bonsai_file(tmp)
+            # Slower frames at the start and a 45 ms hiccup later on
+            steps = np.full(len(raw), 0.025)
+            steps[301:341] = 0.035
+            steps[701] = 0.045
+            raw['Timestamp'] = 1000 + np.cumsum(steps)
+            raw.to_csv(filename, index=False)
+            df = import_bonsai_file(filename, frameshift=True)
+            self.assertEqual(len(df.attrs['frame drops']['row']), 1)
+            for chunksize in [7, 300]:
+                chunked = import_bonsai_file(filename, frameshift=True,
+                                             chunksize=chunksize)
+                pd.testing.assert_frame_equal(df, chunked)
+                self.assertEqual(chunked.attrs, df.attrs)
+
+    def test_import_fpho_data_frameshift(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            filename, raw = write_bonsai_file(tmp)
+            raw.drop(index=[500, 904, 905]).to_csv(filename, index=False)
+            df = import_bonsai_file(filename, frameshift=True, framedrops=2)
+            # Every frame still comes from the channel it is labelled with
+            green = raw['Region2G'][raw['Flags'] == 18]
+            self.assertTrue(np.isin(df['f1GreenGreen'].round(6),
+                                    green.round(6)).all())
+            self.assertTrue((df['fTimeRed'] - df['fTimeGreen'] < 0.03).all())
+            self.assertTrue((df['fTimeIso'] - df['fTimeGreen'] < 0.06).all())
+            self.assertEqual(len(df), (1199 - 301) // 3 - 2)
+            report = pd.DataFrame(df.attrs['frame drops'])
+            self.assertEqual(list(report['row']), [499, 903])
+            self.assertEqual(list(report['Flags']), ['18-17', '17'])
+            self.assertEqual(list(report['phase']), [2, 0])
+            # First sample after each drop
+            self.assertEqual(list(report['sample']), [66, 200])
+            self.assertAlmostEqual(report['Timestamp'][0], 0.025 * 499)
+            for chunksize in [7, 300, 5000]:
+                chunked = import_bonsai_file(filename, frameshift=True,
+                                             framedrops=2,
+                                             chunksize=chunksize)
+                pd.testing.assert_frame_equal(df, chunked)
+                self.assertEqual(chunked.attrs, df.attrs)
+
+    def test_align_video_frames(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            filename, raw = write_bonsai_file(tmp)
+            df = import_bonsai_file(filename)
+            self.assertEqual(df.attrs['start time'], 1000)
+            # Video frames 34 ms apart in clock time, the last line is
+            # partly written
+            video = 1000000 + 34 * np.arange(800)
+            video_file = os.path.join(tmp, 'video time stamp.csv')
+            with open(video_file, 'w') as f:
+                f.write('\n'.join(str(t) + ' ' for t in video) + '\n1000\n')
+            frame_index = behavior_setup.align_video_frames(df, video_file)
+            self.assertEqual(len(frame_index), 800)
+            # 20 s into a 30 fps video is frame 600, at 1020.4 s
+            sample = behavior_setup.video_time_to_sample([20.0],
+                                                         frame_index, 30)
+            green = 1000 + df['fTimeGreen']
+            self.assertEqual(sample[0], (green - 1020.4).abs().idxmin())
+
+    def test_import_behavior_data(self):
+        df = pd.DataFrame({'fTimeGreen': np.arange(100) * 0.1})
+        events = [(1.0, 'Sniff', 'POINT'), (2.0, 'Walk', 'START'),
+                  (2.5, 'Sniff', 'POINT'), (3.0, 'Walk', 'STOP'),
+                  (5.0, 'Walk', 'START'), (5.2, 'Walk', 'STOP'),
+                  (20.0, 'Sniff', 'POINT')]
+        with tempfile.TemporaryDirectory() as tmp:
+            df = behavior_setup.import_behavior_data(
+                write_boris_file(tmp, events), df)
+            self.assertEqual(df.attrs['behaviors']['Walk'],
+                             {'start': [20, 50], 'stop': [31, 53],
+                              'subject': ['vole1', 'vole1']})
+            sniff, found = behavior_setup.behavior_mask(df, ['Sniff'])
+            self.assertTrue(found)
+            self.assertEqual(list(np.flatnonzero(sniff)), [10, 25])
+            either = behavior_setup.behavior_mask(df, ['Sniff', 'Walk'])[0]
+            self.assertEqual(list(np.flatnonzero(either)),
+                             [10] + list(range(20, 31)) + [50, 51, 52])
+            self.assertFalse(behavior_setup.behavior_mask(df, ['Rest'])[1])
+            self.assertEqual(list(df.columns), ['fTimeGreen'])
+            # Decimating keeps a behavior on samples whose block has it
+            df['f1GreenGreen'] = 1.0
+            decimated = fpho_setup.filter_channels(df, decimate=4)
+            self.assertEqual(decimated.attrs['behaviors']['Walk']['start'],
+                             [5, 12])
+            self.assertEqual(decimated.attrs['behaviors']['Walk']['stop'],
+                             [8, 14])
+            # The input session keeps its own intervals
+            self.assertEqual(df.attrs['behaviors']['Walk']['start'],
+                             [20, 50])
+            self.assertEqual(df.attrs['behaviors']['Walk']['stop'], [31, 53])
+            self.assertNotIn('filter', df.attrs)
+            # A START without its STOP
+            events = [(2.0, 'Walk', 'START'), (2.5, 'Sniff', 'POINT'),
+                      (2.8, 'Walk', 'START'), (3.0, 'Walk', 'STOP')]
+            with self.assertRaises(SystemExit):
+                behavior_setup.import_behavior_data(
+                    write_boris_file(tmp, events), df)
+
+    def test_behavior_spans(self):
+        df = pd.DataFrame({'fTimeGreen': np.arange(1000) * 0.1})
+        df.attrs['behaviors'] = {'Walk': {'start': [10, 12, 500, 998],
+                                          'stop': [11, 40, 501, 1000],
+                                          'subject': [''] * 4}}
+        x0, x1 = behavior_setup.behavior_spans(df, 'Walk')
+        np.testing.assert_allclose(x0, [1.0, 1.2, 50.0, 99.8])
+        np.testing.assert_allclose(x1, [1.1, 4.0, 50.1, 99.9])
+        # At 100 pixels a pixel is ~1 s, close spans are merged
+        x0, x1 = behavior_setup.behavior_spans(df, 'Walk', 100)
+        np.testing.assert_allclose(x0, [1.0, 50.0, 99.8])
+        np.testing.assert_allclose(x1, [4.0, 50.1, 99.9])
+        x0, x1 = behavior_setup.behavior_spans(df, 'Walk', 100, 'cull')
+        np.testing.assert_allclose(x0, [1.0])
+        np.testing.assert_allclose(x1, [4.0])
+
+    def test_peri_event(self):
+        rng = np.random.default_rng(0)
+        time = np.arange(2000) * 0.1
+        signal = rng.normal(size=2000)
+        df = pd.DataFrame({'fTimeGreen': time, 'f1GreenGreen': signal})
+        # The first event has no room for its baseline, the last one
+        # no room for its window
+        events = [2.0, 50.0, 120.0, 199.0]
+        results = behavior_setup.peri_event(df, 'f1GreenGreen', events,
+                                            pre=1, post=5)
+        np.testing.assert_allclose(results['time'], np.arange(-10, 51) / 10)
+        np.testing.assert_allclose(results['events'], [2.0, 50.0, 120.0])
+        np.testing.assert_allclose(results['trials'][1], signal[490:551])
+        np.testing.assert_allclose(results['zscore'][1],
+                                   stats.zscore(signal[490:551]))
+        np.testing.assert_allclose(results['mean'],
+                                   results['zscore'].mean(axis=0))
+        np.testing.assert_allclose(results['sem'],
+                                   stats.sem(results['zscore'], axis=0))
+
+        results = behavior_setup.peri_event(df, 'f1GreenGreen', events,
+                                            baseline='pre',
+                                            baseline_window=(4, 3))
+        np.testing.assert_allclose(results['events'], [50.0, 120.0])
+        np.testing.assert_allclose(
+            results['zscore'][0],
+            (signal[490:551] - signal[460:470].mean()) / signal.std())
+        results = behavior_setup.peri_event(df, 'f1GreenGreen', events,
+                                            baseline='session')
+        np.testing.assert_allclose(
+            results['zscore'][0],
+            (signal[10:71] - signal.mean()) / signal.std())
+        with self.assertRaises(SystemExit):
+            behavior_setup.peri_event(df, 'f1GreenGreen', events,
+                                      baseline='median')
+
+    def test_read_boris_csv(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            # Tabular export with a longer metadata block
+            filename = write_boris_file(tmp, [(1.5, 'Sniff', 'POINT')])
+            with open(filename) as f:
+                text = f.read()
+            with open(filename, 'w') as f:
+                f.write('independent variables,\nvariable,value\n'
+                        'weight,40\n' + text)
+            sniffed = behavior_setup.sniff_boris_csv(filename)
+            self.assertEqual(sniffed['header'], 18)
+            self.assertEqual(sniffed['format'], 'tabular')
+            self.assertTrue(sniffed['independent variables'])
+            data = behavior_setup.read_boris_csv(filename)
+            self.assertEqual(data.values.tolist(),
+                             [[1.5, 'vole1', 'Sniff', 'POINT']])
+
+            # Aggregated export, state events are split in START and STOP
+            with open(filename, 'w') as f:
+                f.write('Observation id,Subject,Behavior,Behavior type,'
+                        'Start (s),Stop (s),Duration (s)\n'
+                        'test,vole1,Walk,STATE,2.0,3.5,1.5\n'
+                        'test,vole2,Sniff,POINT,4.0,4.0,\n')
+            self.assertEqual(
+                behavior_setup.sniff_boris_csv(filename)['format'],
+                'aggregated')
+            data = behavior_setup.read_boris_csv(filename)
+            self.assertEqual(data.values.tolist(),
+                             [[2.0, 'vole1', 'Walk', 'START'],
+                              [3.5, 'vole1', 'Walk', 'STOP'],
+                              [4.0, 'vole2', 'Sniff', 'POINT']])
+            self.assertEqual(data['Time'].dtype, np.float64)
+
+        # List of event times without a Status
+        data = behavior_setup.read_boris_csv('Python/SampleData/'
+                                             '1FiberBORIS.csv')
+        self.assertEqual(len(data), 13)
+        self.assertEqual(data.loc[0, 'Time'], 518.233)
+        self.assertTrue((data['Status'] == 'POINT').all())
+
+    def test_intervals(self):
+        rng = np.random.default_rng(0)
+        masks = rng.random((2, 200)) < 0.3
+        a = behavior_setup.mask_to_intervals(masks[0])
+        b = behavior_setup.mask_to_intervals(masks[1])
+        np.testing.assert_array_equal(
+            behavior_setup.intervals_to_mask(a, 200), masks[0])
+        for combine, expected in [
+                (behavior_setup.union_intervals, masks[0] | masks[1]),
+                (behavior_setup.intersect_intervals, masks[0] & masks[1]),
+                (behavior_setup.difference_intervals,
+                 masks[0] & ~masks[1])]:
+            start, stop = combine(a, b)
+            np.testing.assert_array_equal(
+                behavior_setup.intervals_to_mask((start, stop), 200),
+                expected)
+            # Results are sorted and do not touch
+            self.assertTrue(np.all(start[1:] > stop[:-1]))
+        merged = behavior_setup.merge_intervals(([5, 0, 3, 9], [8, 4, 4, 9]))
+        self.assertEqual([list(x) for x in merged], [[0, 5], [4, 8]])
+        kept = behavior_setup.filter_intervals(merged, 4, 4)
+        self.assertEqual([list(x) for x in kept], [[0], [4]])
+
+    def test_legacy_flags(self):
+        rng = np.random.default_rng(0)
+        time = 25 * np.arange(40000) + rng.normal(0, 2, 40000)
+        flags = fpho_setup.legacy_flags(np.delete(time, 100), first_flag=20)
+        expected = np.delete(np.resize([20, 17, 18], 40000), 100)
+        self.assertTrue((flags == expected).all())
+        index = fpho_setup.nearest_index(np.array([0., 10., 20.]),
+                                         np.array([-5, 4, 6, 16, 30]))
+        self.assertEqual(list(index), [0, 0, 1, 2, 2])
+
+    def test_import_fpho_data_legacy(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            _, raw = write_bonsai_file(tmp)
+            raw = raw.drop(index=[500])
+            # Older rigs: no header, time in ms, lines end with a space
+            signal = os.path.join(tmp, 'legacySignal.csv')
+            legacy = raw[['Timestamp', 'FrameCounter', 'Region2G',
+                          'Region3G']].copy()
+            legacy['Timestamp'] *= 1000
+            legacy['End'] = ''
+            legacy.to_csv(signal, sep=' ', header=False, index=False)
+            timestamps = os.path.join(tmp, 'legacyTimestamp.csv')
+            video = 1000003 + 1000 / 30 * np.arange(1000)
+            pd.DataFrame(video).to_csv(timestamps, header=False, index=False)
+            df = fpho_setup.import_fpho_data(
+                input_filename=signal, output_filename='my_file_name',
+                f1greencol=2, f1redcol=3, f2greencol=None, f2redcol=None,
+                animal_ID='vole1', exp_date='2020-09-01',
+                exp_desc='testing', frameshift=True,
+                timestamp_filename=timestamps, first_flag=17)
+            self.assertEqual(len(df), (1198 - 301) // 3 - 1)
+            green = raw['Region2G'][raw['Flags'] == 18]
+            self.assertTrue(np.isin(df['f1GreenGreen'].round(6),
+                                    green.round(6)).all())
+            self.assertEqual(pd.DataFrame(df.attrs['frame drops'])['row'][0],
+                             499)
+            green_ms = 1000 * (1000 + df['fTimeGreen'])
+            expected = np.abs(green_ms.to_numpy()[:, None]
+                              - video[None, :]).argmin(axis=1)
+            self.assertTrue((df['VideoFrame'] == expected).all())
+
+    def test_normalize(self):
+        rng = np.random.default_rng(0)
+        time = np.arange(4000) * 0.075
+        bleach = np.exp(-time / 300)
+        reference = 20 * bleach + 300 + rng.normal(0, 0.5, 4000)
+        signal = 2 * reference + rng.normal(0, 0.5, 4000)
+        result = fpho_setup.normalize(time, signal, reference)
+        self.assertEqual(sorted(result['signal parameters']), list('ABCDE'))
+        self.assertGreater(result['signal rsquare'], 0.9)
+        self.assertAlmostEqual(np.mean(result['normalized']), 1, delta=0.01)
+        df = pd.DataFrame({'fTimeGreen': time, 'f1GreenGreen': signal,
+                           'f1GreenIso': reference})
+        df = fpho_setup.normalize_channels(df, ['f1GreenGreen'],
+                                           ['f1GreenIso'])
+        np.testing.assert_allclose(df['f1GreenGreen final normalized'],
+                                   result['normalized'])
+        # Two signals share a reference, the fits do not depend on the
+        # number of processes
+        df['f2GreenGreen'] = signal[::-1].copy()
+        serial = fpho_setup.normalize_channels(
+            df.copy(), ['f1GreenGreen', 'f2GreenGreen'],
+            ['f1GreenIso', 'f1GreenIso'])
+        parallel = fpho_setup.normalize_channels(
+            df.copy(), ['f1GreenGreen', 'f2GreenGreen'],
+            ['f1GreenIso', 'f1GreenIso'], workers=2)
+        pd.testing.assert_frame_equal(serial, parallel, check_exact=True)
+        df = df.drop(columns='f2GreenGreen')
+
+        # Normalizing again replaces the columns and keeps the attrs
+        df.attrs['animalID'] = 'vole1'
+        again = fpho_setup.normalize_channels(df, ['f1GreenGreen'],
+                                              ['f1GreenIso'])
+        self.assertEqual(list(again.columns), list(df.columns))
+        self.assertEqual(again.attrs, {'animalID': 'vole1'})
+
+    def test_fit_biexponential(self):
+        time = np.arange(8000) * 0.075 + 7.5
+        params = (100, 1 / 30, 50, 1 / 1000, 300)
+        jacobian = fpho_setup.fit_exp_jacobian(time, *params)
+        for i in range(5):
+            step = np.zeros(5)
+            step[i] = 1e-6 * max(params[i], 1)
+            numeric = (fpho_setup.fit_exp(time, *(params + step))
+                       - fpho_setup.fit_exp(time, *(params - step))) / (
+                           2 * step[i])
+            np.testing.assert_allclose(jacobian[:, i], numeric, rtol=1e-4,
+                                       atol=1e-6)
+
+        rng = np.random.default_rng(0)
+        values = fpho_setup.fit_exp(time, *params) + rng.normal(0, 1, 8000)
+        popt, iterations = fpho_setup.fit_biexponential(time, values)
+        np.testing.assert_allclose(popt, params, rtol=0.1)
+        self.assertLess(iterations, 100)
+
+    def test_fit_biexponential_coarse(self):
+        time = np.arange(40000) * 0.075
+        t, y = fpho_setup.block_average(time, time * 2, 300)
+        self.assertEqual(len(t), 301)
+        np.testing.assert_allclose(y, 2 * t)
+
+        rng = np.random.default_rng(0)
+        params = (100, 1 / 30, 50, 1 / 1000, 300)
+        values = fpho_setup.fit_exp(time, *params) + rng.normal(0, 1, 40000)
+        coarse, _, fidelity = fpho_setup.fit_biexponential_coarse(
+            time, values, 2000, refine=False)
+        self.assertIsNone(fidelity)
+        fine, _, fidelity = fpho_setup.fit_biexponential_coarse(
+            time, values, 2000)
+        full, _ = fpho_setup.fit_biexponential(time, values)
+        np.testing.assert_allclose(fine, full, rtol=1e-4)
+        np.testing.assert_allclose(coarse, full, rtol=0.05)
+        self.assertLess(fidelity, 0.1)
+
+    def test_fit_cache(self):
+        rng = np.random.default_rng(0)
+        time = np.arange(4000) * 0.075
+        reference = 20 * np.exp(-time / 300) + 300 + rng.normal(0, 0.5, 4000)
+        signal = 2 * reference + rng.normal(0, 0.5, 4000)
+        with tempfile.TemporaryDirectory() as tmp:
+            first = fpho_setup.normalize(time, signal, reference,
+                                         cache_dir=tmp)
+            self.assertEqual(len(os.listdir(os.path.join(tmp, 'fits'))), 3)
+            second = fpho_setup.normalize(time, signal, reference,
+                                          cache_dir=tmp)
+            self.assertEqual(second['signal iterations'], 0)
+            np.testing.assert_array_equal(first['normalized'],
+                                          second['normalized'])
+            self.assertEqual(first['linfit parameters'],
+                             second['linfit parameters'])
+
+            # Fits from an older fitting algorithm are not reused
+            version = fpho_setup.FIT_VERSION
+            try:
+                fpho_setup.FIT_VERSION = version + 1
+                third = fpho_setup.normalize(time, signal, reference,
+                                             cache_dir=tmp)
+            finally:
+                fpho_setup.FIT_VERSION = version
+            self.assertGreater(third['signal iterations'], 0)
+            self.assertEqual(len(os.listdir(os.path.join(tmp, 'fits'))), 6)
+
+            # The least recently used fits are removed
+            for i in range(4):
+                cache_setup.save_fit(tmp, 'key%d' % i, [i], max_fits=3)
+            self.assertEqual(sorted(os.listdir(os.path.join(tmp, 'fits'))),
+                             ['key1.json', 'key2.json', 'key3.json'])
+            self.assertEqual(cache_setup.load_fit(tmp, 'key3'), [3])
+            self.assertIsNone(cache_setup.load_fit(tmp, 'key0'))
+
+    def test_fit_linear(self):
+        rng = np.random.default_rng(0)
+        x = rng.normal(1, 0.01, 10000)
+        y = 0.8 * x + 0.2 + rng.normal(0, 0.001, 10000)
+        a, b = fpho_setup.fit_linear(x, y)
+        popt, _ = curve_fit(fpho_setup.lin_fit, x, y,
+                            bounds=([0, -5], [np.inf, 5]))
+        np.testing.assert_allclose((a, b), popt, rtol=1e-4)
+        # Bounds of A and B
+        self.assertEqual(fpho_setup.fit_linear(x, 10 - x)[1], 5)
+        self.assertEqual(fpho_setup.fit_linear(x, 3 * x - 7)[1], -5)
+        self.assertEqual(fpho_setup.fit_linear(x, 1 - 2 * x)[0], 0)
+        # Motion artifacts move the robust fit much less
+        y[:200] += 0.05
+        plain = fpho_setup.fit_linear(x, y)
+        robust = fpho_setup.fit_linear(x, y, robust=True)
+        error = [np.abs(a * x + b - (0.8 * x + 0.2)).mean()
+                 for a, b in [plain, robust]]
+        self.assertLess(error[1], error[0] / 10)
+
+    def test_detrenders(self):
+        rng = np.random.default_rng(0)
+        time = np.arange(20000) * 0.075
+        baseline = 100 * np.exp(-time / 300) + 500
+        # A patch cord swap halfway through
+        baseline[10000:] -= 30
+        values = baseline + rng.normal(0, 1, 20000)
+        for method in fpho_setup.DETRENDERS:
+            fit = fpho_setup.fit_channel(time, values, .01,
+                                         detrend_method=method)
+            self.assertEqual(len(fit['fit']), 20000)
+            # Close to the baseline away from the edges and the swap
+            middle = np.r_[2000:9000, 12000:18000]
+            self.assertLess(np.median(np.abs(fit['fit'] - baseline)[middle]),
+                            5, method)
+        fit = fpho_setup.fit_channel(time, values, .01, detrend_method='als',
+                                     detrend_options={'lam': 1e6})
+        self.assertEqual(fit['parameters']['lam'], 1e6)
+        with self.assertRaises(SystemExit):
+            fpho_setup.fit_channel(time, values, .01, detrend_method='x')
+
+    def test_transform_channels(self):
+        rng = np.random.default_rng(0)
+        time = np.arange(2000) * 0.1
+        normalized = 1 + 0.01 * rng.normal(size=2000)
+        df = pd.DataFrame({'fTimeGreen': time,
+                           'f1GreenGreen final normalized': normalized})
+        df.attrs['animalID'] = 'vole1'
+        df = fpho_setup.transform_channels(df, ['f1GreenGreen'], 10)
+        np.testing.assert_allclose(df['f1GreenGreen dF/F'], normalized - 1)
+        np.testing.assert_allclose(df['f1GreenGreen zscore'],
+                                   stats.zscore(normalized))
+        # 10 s windows are 101 samples, centered on each sample
+        rolling = pd.Series(normalized).rolling(101, center=True,
+                                                min_periods=1)
+        expected = (normalized - rolling.mean()) / rolling.std(ddof=0)
+        np.testing.assert_allclose(df['f1GreenGreen rolling zscore'],
+                                   expected, atol=1e-9)
+        self.assertEqual(df.attrs, {'animalID': 'vole1',
+                                    'rolling zscore window': 10})
+        with self.assertRaises(SystemExit):
+            fpho_setup.transform_channels(df, ['f2GreenGreen'])
+
+    def test_filter_channels(self):
+        time = np.arange(4000) * 0.025
+        slow = np.sin(2 * np.pi * 0.5 * time)
+        fast = np.sin(2 * np.pi * 15 * time)
+        behavior = np.zeros(4000, dtype=bool)
+        behavior[1001] = True
+        df = pd.DataFrame({'fTimeGreen': time,
+                           'f1GreenGreen final normalized': slow + fast,
+                           'f1GreenGreen': slow + fast,
+                           'Sniff': behavior,
+                           'f1GreenGreen expfit parameters':
+                               ['A= 1'] + ['na'] * 3999})
+        df.attrs['animalID'] = 'vole1'
+        df.attrs['frame drops'] = {'row': [900], 'sample': [199]}
+        # 40 Hz to 10 Hz, the 15 Hz part would alias to 5 Hz
+        out = fpho_setup.filter_channels(df, lowpass=3, decimate=4)
+        self.assertEqual(len(out), 1000)
+        np.testing.assert_allclose(out['fTimeGreen'], time[::4])
+        middle = slice(100, 900)
+        np.testing.assert_allclose(
+            out['f1GreenGreen final normalized'][middle], slow[::4][middle],
+            atol=0.01)
+        # Other channels are only low-passed against aliasing, at
+        # 0.8 times the new 5 Hz Nyquist frequency
+        self.assertAlmostEqual(out.attrs['filter']['anti-alias cutoff'], 4)
+        np.testing.assert_allclose(out['f1GreenGreen'][middle],
+                                   slow[::4][middle], atol=0.01)
+        np.testing.assert_array_equal(
+            fpho_setup.filter_channels(df, lowpass=3)['f1GreenGreen'],
+            slow + fast)
+        self.assertEqual(out.attrs['frame drops'],
+                         {'row': [900], 'sample': [49]})
+        self.assertEqual(out['Sniff'].sum(), 1)
+        self.assertTrue(out['Sniff'][250])
+        self.assertEqual(out['f1GreenGreen expfit parameters'][0], 'A= 1')
+        self.assertEqual(out.attrs['animalID'], 'vole1')
+        self.assertEqual(out.attrs['filter']['decimate'], 4)
+        self.assertAlmostEqual(out.attrs['filter']['sampling rate'], 10)
+        # Filtering twice is skipped
+        self.assertEqual(len(fpho_setup.filter_channels(out, decimate=4)),
+                         1000)
+        with self.assertRaises(SystemExit):
+            fpho_setup.filter_channels(df, decimate=0)
+        # The anti-aliasing low-pass is 4 Hz, below the high-pass
+        with self.assertRaises(SystemExit):
+            fpho_setup.filter_channels(df, highpass=5, decimate=4)
+        with self.assertRaises(SystemExit):
+            fpho_setup.filter_channels(df, lowpass=30)
+        with self.assertRaises(SystemExit):
+            fpho_setup.filter_channels(df, lowpass=3, columns=['f2RedRed'])
+        # Filtered data never replaces the summary it came from
+        self.assertEqual(cache_setup.filtered_filename('a_Summary.csv'),
+                         'a_Summary_Filtered.csv')
+        self.assertEqual(cache_setup.filtered_filename('a_Summary/'),
+                         'a_Summary_Filtered')
+
     def test_fit_exp(self):
         fit = fpho_setup.fit_exp([0, 0, 0, 0, 0], 1, 1, 1, 1)
         self.assertEqual(2.0, fit[0])